@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark of runtex commands on synthetic TeX projects.
+
+Each run generates a project with nested ``\\input`` files, png/eps figures and a large binary,
+a stand-in ``remotedir``, and (unless ``--real``) puts ``fake_latexmk.py`` on PATH as ``latexmk``
+and ``pdflatex``. Then ``compile``, ``archive``, ``JHEP``, ``push`` and ``pull`` are timed, and
+the results are saved in ``bench/results`` for comparison across versions.
+
+    ./bench/benchmark.py                         # default size
+    ./bench/benchmark.py -n 200 -m 100 --eps 50  # larger project
+    ./bench/benchmark.py --compare bench/results/OLD.json
+    ./bench/benchmark.py --runtex /path/to/another/runtex.py
+    ./bench/benchmark.py -r 1 --max-startup 0.1  # guard the startup time
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import random
+import struct
+import zlib
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+default_runtex = os.path.join(bench_dir, '..', 'runtex.py')
+results_dir = os.path.join(bench_dir, 'results')
+
+
+def png(width, height, rng):
+    """Return a valid PNG image of random pixels."""
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+    rows = b''.join(b'\0' + bytes(rng.getrandbits(8) for _ in range(width * 3)) for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows, 1)) + chunk(b'IEND', b''))
+
+
+def eps(index, lines):
+    """Return a valid EPS file drawing ``lines`` random lines."""
+    body = ''.join('{} {} moveto {} {} lineto stroke\n'.format(*(((index + i * k) * 37) % 100 for k in range(1, 5)))
+                   for i in range(lines))
+    return ('%!PS-Adobe-3.0 EPSF-3.0\n%%BoundingBox: 0 0 100 100\n' + body + 'showpage\n%%EOF\n').encode()
+
+
+def make_project(root, inputs, figures, eps_figures, depth, figure_kb, binary_mb, seed=0):
+    """Create a synthetic project in ``root``, returning the path of the main TeX file."""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(root, 'figures', 'eps'))
+    os.makedirs(os.path.join(root, 'data'))
+
+    side = max(1, int((figure_kb * 1000 / 3) ** 0.5))
+    for i in range(figures):
+        with open(os.path.join(root, 'figures', 'fig{:03d}.png'.format(i)), 'wb') as f:
+            f.write(png(side, side, rng))
+    for i in range(eps_figures):
+        with open(os.path.join(root, 'figures', 'eps', 'plot{:03d}.eps'.format(i)), 'wb') as f:
+            f.write(eps(i, 200))
+    with open(os.path.join(root, 'data', 'large.bin'), 'wb') as f:
+        for _ in range(binary_mb):
+            f.write(rng.getrandbits(8 * 1000000).to_bytes(1000000, 'little'))
+    with open(os.path.join(root, 'refs.bib'), 'w') as f:
+        f.write(''.join('@article{{ref{0},\n  title={{Title {0}}},\n  author={{Author}},\n  year={{2020}}\n}}\n'
+                        .format(i) for i in range(20)))
+
+    # sections nested ``depth`` levels: sections/s1/s2/.../secNNN.tex
+    inputs_per_level = [[] for _ in range(depth)]
+    for i in range(inputs):
+        inputs_per_level[i % depth].append(i)
+    for level, indices in enumerate(inputs_per_level):
+        directory = os.path.join('sections', *['s{}'.format(k) for k in range(1, level + 1)])
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+        for i in indices:
+            with open(os.path.join(root, directory, 'sec{:03d}.tex'.format(i)), 'w') as f:
+                f.write('\\section{{Section {0}}}\nText of section {0} \\cite{{ref{1}}}.\n'.format(i, i % 20))
+                if i < figures:
+                    f.write('\\includegraphics[width=3cm]{{fig{:03d}}}\n'.format(i))
+                if i < eps_figures:
+                    f.write('\\includegraphics[width=3cm]{{eps/plot{:03d}}}\n'.format(i))
+
+    texfile = 'paper.tex'
+    with open(os.path.join(root, texfile), 'w') as f:
+        f.write('\\documentclass{article}\n\\usepackage{graphicx}\n\\graphicspath{{figures/}}\n'
+                '\\begin{document}\n')
+        for level, indices in enumerate(inputs_per_level):
+            directory = '/'.join(['sections'] + ['s{}'.format(k) for k in range(1, level + 1)])
+            for i in indices:
+                f.write('\\input{{{}/sec{:03d}}}\n'.format(directory, i))
+        f.write('\\bibliographystyle{plain}\n\\bibliography{refs}\n\\end{document}\n')
+    return texfile
+
+
+def install_fake_tex(bindir):
+    for name in ['latexmk', 'pdflatex']:
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, os.path.join(bench_dir, 'fake_latexmk.py')))
+        os.chmod(path, 0o755)
+
+
+def run(runtex, args, cwd, env):
+    begin = time.perf_counter()
+    result = subprocess.run([sys.executable, runtex] + args, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - begin
+    if result.returncode != 0:
+        sys.stdout.write(result.stdout.decode('utf-8', 'replace'))
+        raise RuntimeError('runtex {} failed with exit code {}'.format(' '.join(args), result.returncode))
+    return elapsed
+
+
+def benchmark(options):
+    runtex = os.path.abspath(options.runtex)
+    workdir = tempfile.mkdtemp(prefix='runtex-bench-')
+    env = dict(os.environ)
+    if not options.real:
+        bindir = os.path.join(workdir, 'bin')
+        os.makedirs(bindir)
+        install_fake_tex(bindir)
+        env['PATH'] = bindir + os.pathsep + env.get('PATH', '')
+        env['FAKE_LATEXMK_DELAY'] = str(options.delay)
+    elif not shutil.which('latexmk'):
+        sys.exit('--real requires latexmk.')
+
+    timings = dict()
+    try:
+        for repeat in range(options.repeat):
+            project = os.path.join(workdir, 'project{}'.format(repeat))
+            remote = os.path.join(workdir, 'remote{}'.format(repeat))
+            os.makedirs(project)
+            os.makedirs(remote)
+            texfile = make_project(project, options.inputs, options.figures, options.eps, options.depth,
+                                   options.figure_kb, options.binary_mb)
+            with open(os.path.join(project, 'runtex.conf'), 'w') as f:
+                f.write('---\ntexfile: {}\nremotedir: {}\nextra:\n  - data/large.bin\n'.format(texfile, remote))
+
+            steps = [
+                ('compile', ['compile']),
+                ('archive', ['archive', '_v{}'.format(repeat)]),
+                ('JHEP', ['JHEP', '_j{}'.format(repeat)]),
+                ('push (create)', ['push', '-y']),
+                ('push (unchanged)', ['push', '-y']),
+                ('pull (unchanged)', ['pull', '-y']),
+            ]
+            for name, args in steps:
+                elapsed = run(runtex, args, project, env)
+                timings.setdefault(name, []).append(elapsed)
+                print('  {:<20} {:8.3f} s'.format(name, elapsed))
+            # startup: the fastest of several runs, with the configuration cache warmed by the steps above.
+            elapsed = min(run(runtex, ['-V'], project, env) for _ in range(options.startup_runs))
+            timings.setdefault('startup (-V)', []).append(elapsed)
+            print('  {:<20} {:8.3f} s'.format('startup (-V)', elapsed))
+    finally:
+        if not options.keep:
+            shutil.rmtree(workdir)
+        else:
+            print('Work directory kept: ' + workdir)
+
+    return {name: {'min': min(values), 'median': statistics.median(values), 'runs': values}
+            for name, values in timings.items()}
+
+
+def runtex_version(runtex):
+    with open(runtex) as f:
+        match = re.search(r"^version = '([^']*)'", f.read(), re.MULTILINE)
+    return match.group(1) if match else 'unknown'
+
+
+def compare(results, old):
+    print('\n  {:<20} {:>10} {:>10} {:>8}'.format('command', 'old [s]', 'new [s]', 'ratio'))
+    for name, value in results['timings'].items():
+        if name in old.get('timings', {}):
+            before = old['timings'][name]['median']
+            print('  {:<20} {:10.3f} {:10.3f} {:8.2f}'.format(name, before, value['median'], value['median'] / before))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark runtex commands on a synthetic project.')
+    parser.add_argument('--runtex', default=default_runtex, help='runtex.py to benchmark')
+    parser.add_argument('-n', '--inputs', type=int, default=50, help='number of \\input files')
+    parser.add_argument('-m', '--figures', type=int, default=20, help='number of png figures')
+    parser.add_argument('--eps', type=int, default=10, help='number of eps figures')
+    parser.add_argument('--depth', type=int, default=3, help='depth of nested section directories')
+    parser.add_argument('--figure-kb', type=int, default=100, help='size of each png figure in kB')
+    parser.add_argument('--binary-mb', type=int, default=20, help='size of the large binary in MB')
+    parser.add_argument('--delay', type=float, default=0.05, help='seconds per pass of the fake latexmk')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--startup-runs', type=int, default=10, help='runs of "runtex -V" to measure startup')
+    parser.add_argument('--max-startup', type=float, metavar='SECONDS',
+                        help='fail if the startup time (median) exceeds SECONDS')
+    parser.add_argument('--real', action='store_true', help='use the installed TeX instead of the fake latexmk')
+    parser.add_argument('--keep', action='store_true', help='keep the generated projects')
+    parser.add_argument('--compare', metavar='JSON', help='results of a previous run to compare with')
+    parser.add_argument('-o', '--output', metavar='JSON', help='file to save the results')
+    options = parser.parse_args()
+
+    version = runtex_version(options.runtex)
+    print('Benchmark of runtex {} ({})'.format(version, 'real TeX' if options.real else 'fake latexmk'))
+    results = {
+        'version': version,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'parameters': {k: v for k, v in vars(options).items()
+                       if k not in ['compare', 'output', 'keep', 'max_startup']},
+        'timings': benchmark(options),
+    }
+
+    output = options.output or os.path.join(results_dir, '{}-{}.json'.format(version, time.strftime('%Y%m%d-%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('Results saved in ' + output)
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+    if options.max_startup is not None and results['timings']['startup (-V)']['median'] > options.max_startup:
+        sys.exit('startup time {:.3f} s exceeds {:.3f} s.'.format(
+            results['timings']['startup (-V)']['median'], options.max_startup))
+
+
+if __name__ == '__main__':
+    main()
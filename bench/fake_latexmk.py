@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""A stand-in for ``latexmk`` (and ``pdflatex``) used by the benchmark.
+
+It follows ``\\input``, ``\\include``, ``\\includegraphics`` (with ``\\graphicspath``) and
+``\\bibliography`` statically, emits ``#===Dependents`` blocks for ``-deps``, and writes the
+outputs runtex expects: ``.pdf``, ``.aux``, ``.log``, ``.fls``, ``.fdb_latexmk``, ``.bbl``, and
+``-eps-converted-to.pdf`` for each eps figure. ``FAKE_LATEXMK_DELAY`` (seconds, default 0.05)
+is spent on each LaTeX pass to imitate typesetting."""
+
+import os
+import re
+import sys
+import time
+
+texmf_files = ['/usr/share/texlive/texmf-dist/tex/latex/base/article.cls',
+               '/usr/share/texlive/texmf-dist/tex/latex/graphics/graphicx.sty']
+graphics_extensions = ['.pdf', '.png', '.jpg', '.eps']
+pattern = re.compile(r'\\(input|include|includegraphics|graphicspath|bibliography)\s*(?:\[[^\]]*\])?'
+                     r'\{((?:[^{}]|\{[^{}]*\})*)\}')
+
+
+def first_existing(candidates):
+    for path in candidates:
+        if os.path.isfile(path):
+            return os.path.normpath(path)
+    return None
+
+
+def scan(texfile, found, missing, graphics_paths):
+    with open(texfile, 'r', errors='replace') as f:
+        text = re.sub(r'(?<!\\)%.*', '', f.read())
+    for command, arg in pattern.findall(text):
+        if command == 'graphicspath':
+            graphics_paths.extend(re.findall(r'\{([^{}]*)\}', arg))
+            continue
+        for name in (arg.split(',') if command == 'bibliography' else [arg]):
+            name = name.strip()
+            if command in ['input', 'include']:
+                path = first_existing([name, name + '.tex'])
+            elif command == 'bibliography':
+                path = first_existing([name + '.bib'])
+            else:
+                path = first_existing([os.path.join(d, name) + e for d in graphics_paths
+                                       for e in [''] + graphics_extensions])
+            if path is None:
+                missing.append(name)
+            elif path not in found:
+                found.append(path)
+                if path.endswith('.tex'):
+                    scan(path, found, missing, graphics_paths)
+
+
+def main(argv):
+    options = dict()
+    files = []
+    for a in argv:
+        if a.startswith('-'):
+            key, _, value = a.partition('=')
+            options[key] = value
+        else:
+            files.append(a)
+    texfile = files[-1] if files[-1].endswith('.tex') else files[-1] + '.tex'
+    stem = options.get('-jobname') or os.path.basename(texfile)[:-4]
+    outdir = options.get('-outdir') or options.get('-output-directory') or '.'
+
+    def out(ext): return os.path.join(outdir, stem + ext)
+
+    generated = ['.aux', '.log', '.fls', '.fdb_latexmk', '.pdf', '.bbl', '.blg', '.out', '.toc']
+    if '-CA' in options or '-C' in options:
+        for ext in generated:
+            if os.path.exists(out(ext)) and not (ext == '.pdf' and '-C' in options):
+                os.remove(out(ext))
+        return 0
+
+    if not os.path.isfile(texfile):
+        print('Latexmk: file "{}" not found'.format(texfile), file=sys.stderr)
+        return 11
+    found, missing = [], []
+    scan(texfile, found, missing, [''])
+    time.sleep(float(os.environ.get('FAKE_LATEXMK_DELAY', '0.05')))
+
+    converted = []
+    for f in found:
+        if f.endswith('.eps'):
+            pdf = f[:-4] + '-eps-converted-to.pdf'
+            if not os.path.exists(pdf) or os.stat(pdf).st_mtime < os.stat(f).st_mtime:
+                with open(f, 'rb') as src, open(pdf, 'wb') as dst:
+                    dst.write(b'%PDF-1.4 converted\n' + src.read())
+            converted.append(pdf)
+    inputs = [f for f in found if not f.endswith('.eps')] + converted
+
+    os.makedirs(outdir, exist_ok=True)
+    with open(out('.aux'), 'w') as f:
+        f.write('\\relax\n')
+    with open(out('.log'), 'w') as f:
+        f.write('This is a fake log of {}.\n'.format(texfile))
+    with open(out('.pdf'), 'wb') as f:
+        f.write(b'%PDF-1.4 fake\n' + ''.join(sorted(found)).encode() * 64)
+    if any(f.endswith('.bib') for f in found):
+        with open(out('.bbl'), 'w') as f:
+            f.write('\\begin{thebibliography}{9}\n\\end{thebibliography}\n')
+    with open(out('.fls'), 'w') as f:
+        f.write('PWD {}\n'.format(os.getcwd()))
+        for path in texmf_files + [texfile] + [x for x in inputs if not x.endswith('.bib')]:
+            f.write('INPUT {}\n'.format(path))
+        for ext in ['.aux', '.log', '.pdf']:
+            f.write('OUTPUT {}\n'.format(out(ext)))
+    with open(out('.fdb_latexmk'), 'w') as f:
+        f.write('# Fdb version 3\n["pdflatex"] 0 "{}" "{}" "{}" 0\n'.format(texfile, out('.pdf'), stem))
+        for path in texmf_files + [texfile] + [x for x in inputs if not x.endswith('.bib')]:
+            f.write('  "{}" 0 0 00000000000000000000000000000000 ""\n'.format(path))
+        f.write('  (generated)\n  "{}"\n  "{}"\n'.format(out('.aux'), out('.log')))
+        bibs = [x for x in found if x.endswith('.bib')]
+        if bibs:
+            f.write('["bibtex {}"] 0 "{}" "{}" "{}" 0\n'.format(stem, out('.aux'), out('.bbl'), stem))
+            for path in bibs:
+                f.write('  "{}" 0 0 00000000000000000000000000000000 ""\n'.format(path))
+            f.write('  (generated)\n  "{}"\n'.format(out('.bbl')))
+
+    if '-deps' in options:
+        print('#===Dependents, and related info, for {}:'.format(texfile))
+        print('{} :\\'.format(out('.pdf')))
+        for path in texmf_files + [texfile] + found + converted:
+            print('    {}\\'.format(path))
+        print('#===End dependents for {}:'.format(texfile))
+    return 12 if missing else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
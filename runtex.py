@@ -3,19 +3,74 @@
 # Time-Stamp: <2020-04-02 12:22:28>
 
 import os
+import re
 import sys
-import yaml
-import shutil
-import tempfile
+import stat
+import time
+import errno
+import signal
+import marshal
 import argparse
-import subprocess
-import filecmp
+import importlib
+import threading
+import functools
+import contextlib
+
+
+class LazyModule:
+    """Module imported on first attribute access, to keep the startup fast.
+    Submodules (e.g., ``concurrent.futures``) are also imported on access."""
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attr):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        try:
+            return getattr(self.__module, attr)
+        except AttributeError:
+            return importlib.import_module(self.__name + '.' + attr)
+
+
+io = LazyModule('io')
+json = LazyModule('json')
+yaml = LazyModule('yaml')
+ctypes = LazyModule('ctypes')
+select = LazyModule('select')
+shutil = LazyModule('shutil')
+struct = LazyModule('struct')
+filecmp = LazyModule('filecmp')
+hashlib = LazyModule('hashlib')
+tarfile = LazyModule('tarfile')
+tempfile = LazyModule('tempfile')
+subprocess = LazyModule('subprocess')
+socket = LazyModule('socket')
+mmap = LazyModule('mmap')
+asyncio = LazyModule('asyncio')
+difflib = LazyModule('difflib')
+zlib = LazyModule('zlib')
+fcntl = LazyModule('fcntl')
+concurrent = LazyModule('concurrent')
 
 product_name = 'RunTeX'
 version = '0.2.0'
 
 latexmk = 'latexmk'
+pdflatex = 'pdflatex'
 config_file = 'runtex.conf'
+cache_dir = '.runtex'
+manifest_file = '.runtex-manifest.json'
+daemon_socket = os.path.join(cache_dir, 'daemon.sock')
+store_dir = '.runtex-store'
+format_dir = os.path.join(cache_dir, 'fmt')
+plan_version = 1
+archive_format = 1  # layout of the archives and their manifests
+gzip_block_size = 1 << 20
+use_cache = True
+assume_yes = False
+plan_file = None
+transfer_jobs = 8
 
 
 class Color:
@@ -74,6 +129,212 @@ class cd:
         os.chdir(self.savedPath)
 
 
+class Profiler:
+    """Recorder of wall and CPU time spent in each phase, enabled by ``--profile``.
+
+    Phases are recorded as a tree by ``phase`` (or the ``profiled`` decorator), while ``total``
+    accumulates time and counts of frequent operations. CPU time includes waited subprocesses."""
+    def __init__(self):
+        self.enabled = False
+        self.root = {'name': 'runtex', 'phases': []}
+        self.stack = [self.root]
+        self.totals = dict()
+        self.lock = threading.Lock()
+        self.begin = self.clock()
+
+    @staticmethod
+    def clock():
+        t = os.times()
+        return time.time(), time.process_time(), t.children_user + t.children_system
+
+    @contextlib.contextmanager
+    def phase(self, name, **info):
+        if not self.enabled or threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        record = dict(name=name, **info)
+        self.stack[-1].setdefault('phases', []).append(record)
+        self.stack.append(record)
+        begin = self.clock()
+        try:
+            yield
+        finally:
+            end = self.clock()
+            record.update(wall=end[0] - begin[0], cpu=end[1] - begin[1], children_cpu=end[2] - begin[2])
+            self.stack.pop()
+
+    @contextlib.contextmanager
+    def total(self, name, **counts):
+        if not self.enabled:
+            yield
+            return
+        begin = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, wall=time.time() - begin[0], **counts)
+
+    def add(self, name, **values):
+        """Accumulate ``values`` (and the number of calls) to the total ``name``."""
+        if not self.enabled:
+            return
+        with self.lock:
+            total = self.totals.setdefault(name, {'count': 0})
+            total['count'] += 1
+            for key, value in values.items():
+                total[key] = total.get(key, 0) + value
+
+    def note(self, **info):
+        """Add ``info`` to the current phase."""
+        if self.enabled and threading.current_thread() is threading.main_thread():
+            self.stack[-1].update(info)
+
+    def profiled(self, func=None, total=False):
+        """Decorator to record each call of ``func`` as a phase, or into a total if ``total``."""
+        if func is None:
+            return functools.partial(self.profiled, total=total)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with (self.total if total else self.phase)(func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def report(self):
+        end = self.clock()
+        return {
+            'product': product_name,
+            'version': version,
+            'argv': sys.argv,
+            'started': self.begin[0],
+            'wall': end[0] - self.begin[0],
+            'cpu': end[1] - self.begin[1],
+            'children_cpu': end[2] - self.begin[2],
+            'phases': self.root.get('phases', []),
+            'totals': self.totals,
+        }
+
+    def save(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+    def summary(self):
+        report = self.report()
+        print("\n\n" + Color.green('Profile:'))
+        fmt = '  {:<48} {:>9} {:>9} {:>9}'
+        print(fmt.format('phase', 'wall [s]', 'cpu [s]', 'sub [s]'))
+
+        def show(phases, depth):
+            for p in phases:
+                print(fmt.format(('  ' * depth + p['name'])[:48], '{:.3f}'.format(p.get('wall', 0)),
+                                 '{:.3f}'.format(p.get('cpu', 0)), '{:.3f}'.format(p.get('children_cpu', 0))))
+                show(p.get('phases', []), depth + 1)
+        show(report['phases'], 0)
+        print(fmt.format('(total)', '{:.3f}'.format(report['wall']), '{:.3f}'.format(report['cpu']),
+                         '{:.3f}'.format(report['children_cpu'])))
+        for name, total in sorted(self.totals.items()):
+            values = ['{}={}'.format(k, '{:.3f}'.format(v) if isinstance(v, float) else v)
+                      for k, v in sorted(total.items())]
+            print('  {} : '.format(name) + ', '.join(values))
+
+
+profiler = Profiler()
+
+
+def run_process(args, **kwargs):
+    """Run ``args`` by ``subprocess.run``, recorded as a phase of ``profiler``."""
+    with profiler.phase('subprocess ' + os.path.basename(args[0]), command=args):
+        return subprocess.run(args, **kwargs)
+
+
+class OutputParser:
+    """Parser of the output of latexmk and TeX, fed line by line by ``stream_process``.
+
+    It collects the files listed by ``latexmk -deps``, the errors (``file:line: message`` with
+    ``-file-line-error``, or ``! message``), and the undefined references and citations."""
+    fatal_pattern = re.compile(r"^! Emergency stop|Fatal error occurred|^! I can't (?:find|write on) file")
+    error_pattern = re.compile(r'^(?:(\S[^:]*):(\d+): |! )(.*)$')
+    undefined_pattern = re.compile(r"(Reference|Citation) [`']([^']*)' on page \d+ undefined")
+
+    def __init__(self):
+        self.dependencies = None
+        self.blocks = 0
+        self.reading = None  # the number of lines read in the block of dependencies
+        self.errors = []
+        self.undefined = []
+
+    def feed(self, line):
+        """Parse ``line``, and return True if it tells a fatal error."""
+        if line.startswith('#===Dependents'):
+            self.blocks += 1
+            self.dependencies = []
+            self.reading = 0
+        elif line.startswith('#===End dependents'):
+            self.reading = None
+        elif self.reading is not None:
+            self.reading += 1
+            if self.reading > 1 and line.strip(" \t\\"):  # the first line is the target
+                self.dependencies.append(line.strip(" \t\\"))
+        else:
+            match = self.error_pattern.match(line)
+            if match and line not in self.errors:
+                self.errors.append(line)
+            match = self.undefined_pattern.search(line)
+            if match and match.group(2) not in self.undefined:
+                self.undefined.append(match.group(2))
+            return bool(self.fatal_pattern.search(line))
+        return False
+
+    def report(self):
+        """Show the errors and the undefined references."""
+        if self.errors:
+            print(Color.red('\n{} error(s):'.format(len(self.errors))))
+            [print('  ' + Color.red(e)) for e in self.errors]
+        if self.undefined:
+            warning('undefined references or citations: ' + ', '.join(self.undefined))
+
+
+def kill_process_tree(pid):
+    """Terminate the process group led by ``pid``, i.e., a process started by ``stream_process`` and its children."""
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def stream_process(args, parser, echo=True, merge_stderr=True, **kwargs):
+    """Run ``args`` in a new process group, feeding ``parser`` with each line of the output (stdout, and
+    stderr if ``merge_stderr``; otherwise stderr is shown as is) as it arrives, echoed if ``echo``. The
+    process tree is killed on a fatal error found by ``parser`` and on KeyboardInterrupt.
+    Return the exit code, or None if killed on an error."""
+    async def run():
+        process = await asyncio.create_subprocess_exec(
+            *args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT if merge_stderr else None, start_new_session=True, limit=1 << 20, **kwargs)
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    return await process.wait()
+                text = line.decode('utf-8', 'replace')
+                if echo:
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+                if parser.feed(text.rstrip('\r\n')):
+                    kill_process_tree(process.pid)
+                    await process.wait()
+                    return None
+        finally:
+            if process.returncode is None:
+                kill_process_tree(process.pid)
+
+    with profiler.phase('subprocess ' + os.path.basename(args[0]), command=args):
+        return asyncio.run(run())
+
+
 def error(text):
     print(Color.red('\n[ERROR] ' + text))
     sys.exit(1)
@@ -90,11 +351,315 @@ def copy_with_mkdir(src, dst):
     return shutil.copy2(src, dst)
 
 
+def ask(question, default=False):
+    """Ask a yes/no ``question``; ``assume_yes`` answers "yes" without asking."""
+    if assume_yes:
+        print(question + 'y')
+        return True
+    answer = input(question).lower()
+    return answer == 'y' if not default else answer != 'n'
+
+
+hash_memo = dict()
+
+
+def file_hash(path):
+    """Return SHA-256 hex digest of the content of ``path``.
+
+    The digest is memorized in ``hash_memo`` while the file status is unchanged, which is
+    effective in a long-lived process, i.e., ``daemon``."""
+    s = os.stat(path)
+    key = (os.path.abspath(path), s.st_size, s.st_mtime_ns, s.st_ino)
+    if key in hash_memo:
+        return hash_memo[key]
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    hash_memo[key] = h.hexdigest()
+    return hash_memo[key]
+
+
+def load_cache(name):
+    """Return the JSON content of ``name`` in ``cache_dir``, or an empty dict if unavailable."""
+    try:
+        with open(os.path.join(cache_dir, name), 'r') as f:
+            content = json.load(f)
+        return content if isinstance(content, dict) else dict()
+    except (OSError, ValueError):
+        return dict()
+
+
+def save_cache(name, content):
+    """Save ``content`` as ``name`` in ``cache_dir``, replacing the old one atomically.
+    Callers merging into the old content should hold ``cache_lock``."""
+    os.makedirs(cache_dir, exist_ok=True)
+    write_json(os.path.join(cache_dir, name), content)
+
+
+@functools.lru_cache(maxsize=None)
+def umask():
+    mask = os.umask(0o22)
+    os.umask(mask)
+    return mask
+
+
+def write_atomically(path, data):
+    """Write ``data`` (bytes) to ``path`` through a unique temporary file renamed to ``path``, so that
+    concurrent writers, e.g., children of ``run_all``, never see nor replace one another's partial file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), 0o666 & ~umask())
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        remove_file(tmp)
+        raise
+
+
+def write_json(path, content):
+    write_atomically(path, json.dumps(content, indent=1, sort_keys=True).encode())
+
+
+def human_size(size):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if size < 1000 or unit == 'GB':
+            return ('{:.0f} {}' if unit == 'B' else '{:.1f} {}').format(size, unit)
+        size /= 1000
+
+
+def copy_content(fsrc, fdst, size):
+    """Copy ``size`` bytes from the file descriptor ``fsrc`` to ``fdst``, with zero-copy system calls if possible.
+    OSError is raised if ``fsrc`` ends before ``size`` bytes, e.g., truncated during the copy."""
+    copied = 0
+    for method in ['copy_file_range', 'sendfile']:
+        if not hasattr(os, method):
+            continue
+        try:
+            while copied < size:
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(fsrc, fdst, min(size - copied, 1 << 30))
+                else:
+                    n = os.sendfile(fdst, fsrc, copied, min(size - copied, 1 << 30))
+                if n == 0:
+                    break  # the rest, if any, is read below.
+                copied += n
+            break
+        except OSError as e:
+            if copied or e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                                         errno.EPERM, errno.EBADF, errno.ENOTSUP]:
+                raise
+    os.lseek(fsrc, copied, os.SEEK_SET)
+    while copied < size:
+        chunk = os.read(fsrc, min(size - copied, 1 << 20))
+        if not chunk:
+            raise OSError(errno.EIO, 'only {} of {} bytes could be read'.format(copied, size))
+        copied += len(chunk)
+        while chunk:
+            chunk = chunk[os.write(fdst, chunk):]
+    return copied
+
+
+def copy_atomically(src, dst):
+    """Copy ``src`` to ``dst`` as ``shutil.copy2``, but through a temporary file renamed to ``dst``
+    so that ``dst`` is never seen half-written. Return the number of bytes copied."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst) or '.', prefix='.' + os.path.basename(dst) + '.')
+    try:
+        with open(src, 'rb') as f:
+            size = copy_content(f.fileno(), fd, os.fstat(f.fileno()).st_size)
+        os.close(fd)
+        fd = None
+        shutil.copystat(src, tmp)
+        # read-only sources, e.g., the objects of an ObjectStore, result in writable copies.
+        os.chmod(tmp, stat.S_IMODE(os.stat(tmp).st_mode) | stat.S_IWUSR)
+        os.replace(tmp, dst)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        remove_file(tmp)
+        raise
+    return size
+
+
+class DeltaCopier:
+    """A copy function that, for ``dst`` to be updated, writes only the regions of ``src`` differing
+    from ``dst`` as rsync does: ``dst`` is split into blocks whose weak (Adler-32) and strong hashes
+    are matched against a rolling checksum over ``src``. ``dst`` is patched in place if the matched
+    blocks are at their original offsets, and otherwise replaced by a patched copy atomically.
+
+    Files smaller than ``min_size`` bytes or without one of ``extensions`` (if given) are copied
+    by ``copy_atomically``. The number of bytes not written is accumulated in ``saved``."""
+    __name__ = 'copy_with_delta'
+    block_size = 1 << 13
+    resync_blocks = 16
+    max_unmatched = 1 << 20
+
+    def __init__(self, min_size=1000000, extensions=None):
+        self.min_size = max(min_size, self.block_size)
+        self.extensions = extensions
+        self.saved = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def strong(block):
+        return hashlib.blake2b(block, digest_size=16).digest()
+
+    def signatures(self, path):
+        """Return a dict from weak to strong hashes to offsets of the whole blocks in ``path``."""
+        signatures = dict()
+        with open(path, 'rb') as f:
+            offset = 0
+            for block in iter(lambda: f.read(self.block_size), b''):
+                if len(block) == self.block_size:
+                    signatures.setdefault(zlib.adler32(block), dict()).setdefault(self.strong(block), offset)
+                offset += len(block)
+        return signatures
+
+    def instructions(self, data, signatures):
+        """Return a list of ``(dst_offset, None, length)`` to reuse blocks of ``dst`` and ``(None, src_offset,
+        length)`` to write the content of ``data``, or None if most of ``data`` has to be written.
+
+        Blocks are first looked up at the offsets aligned to the last match, and the checksum is rolled
+        byte by byte (which is slow in Python) only over a block at the beginning of each unmatched run
+        and every ``resync_blocks`` blocks in it, to find the blocks shifted by insertions or deletions.
+        Unmatched runs longer than ``max_unmatched`` bytes are regarded as unrelated content."""
+        size, n = len(data), self.block_size
+        budget = size // 2
+        result, literal, i = [], 0, 0
+
+        def lookup(position, weak):
+            candidates = signatures.get(weak)
+            return candidates.get(self.strong(data[position:position + n])) if candidates else None
+
+        while i + n <= size:
+            weak = zlib.adler32(data[i:i + n])
+            offset = lookup(i, weak)
+            if offset is None and (i - literal) // n % self.resync_blocks == 0:
+                j = i
+                while offset is None and j < min(i + n, size - n):
+                    # roll the Adler-32 checksum by one byte
+                    out, new = data[j], data[j + n]
+                    a = ((weak & 0xffff) - out + new) % 65521
+                    b = ((weak >> 16) - n * out + a - 1) % 65521
+                    weak = a | (b << 16)
+                    j += 1
+                    offset = lookup(j, weak)
+                if offset is not None:
+                    i = j
+            if offset is not None:
+                if literal < i:
+                    result.append((None, literal, i - literal))
+                    budget -= i - literal
+                result.append((offset, None, n))
+                i = literal = i + n
+                continue
+            i += n
+            if i - literal > min(budget, self.max_unmatched):
+                return None
+        if size - literal > budget:
+            return None
+        if literal < size:
+            result.append((None, literal, size - literal))
+        return result
+
+    def patch(self, data, dst, instructions):
+        """Apply ``instructions`` to ``dst``, returning the number of bytes written."""
+        written = 0
+        s = os.stat(dst)
+        position = 0
+        in_place = s.st_nlink == 1 and os.access(dst, os.W_OK)
+        for dst_offset, src_offset, length in instructions:
+            in_place = in_place and (dst_offset is None or dst_offset == position)
+            position += length
+        if in_place:
+            with open(dst, 'r+b') as f:
+                position = 0
+                for dst_offset, src_offset, length in instructions:
+                    if dst_offset is None:
+                        f.seek(position)
+                        f.write(data[src_offset:src_offset + length])
+                        written += length
+                    position += length
+                f.truncate(position)
+            return written
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst) or '.', prefix='.' + os.path.basename(dst) + '.')
+        try:
+            with open(dst, 'rb') as old, os.fdopen(fd, 'wb') as f:
+                for dst_offset, src_offset, length in instructions:
+                    if dst_offset is None:
+                        f.write(data[src_offset:src_offset + length])
+                        written += length
+                    else:
+                        old.seek(dst_offset)
+                        f.write(old.read(length))
+            shutil.copymode(dst, tmp)
+            os.replace(tmp, dst)
+        except BaseException:
+            remove_file(tmp)
+            raise
+        return written
+
+    def __call__(self, src, dst):
+        size = os.stat(src).st_size
+        if (size < self.min_size or not os.path.isfile(dst) or os.path.islink(dst) or
+                (self.extensions and os.path.splitext(src)[1] not in self.extensions)):
+            return copy_atomically(src, dst)
+        with open(src, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            instructions = self.instructions(data, self.signatures(dst))
+            if instructions is None:
+                return copy_atomically(src, dst)
+            written = self.patch(data, dst, instructions)
+        shutil.copystat(src, dst)
+        os.chmod(dst, stat.S_IMODE(os.stat(dst).st_mode) | stat.S_IWUSR)
+        with self.lock:
+            self.saved += size - written
+        return size
+
+
+def copy_function_of(config):
+    """Return the function to copy files for ``push`` and ``pull`` of ``config``, following "delta",
+    which is true or a dict of "min_size" (in bytes) and "extensions" for ``DeltaCopier``."""
+    delta = config.get('delta')
+    if not delta:
+        return copy_atomically
+    options = delta if isinstance(delta, dict) else dict()
+    return DeltaCopier(min_size=int(options.get('min_size', 1000000)), extensions=options.get('extensions'))
+
+
+def transfer_files(pairs, jobs=None, copy_function=copy_atomically):
+    """Copy files as listed in ``pairs`` of ``(src, dst)`` by ``copy_function`` in ``jobs`` threads.
+    The directories are created beforehand. Yield ``(src, dst, size, seconds)`` as each copy finishes."""
+    for dirname in sorted(set(os.path.dirname(dst) for _, dst in pairs)):
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+    def copy(src, dst):
+        begin = time.time()
+        size = copy_function(src, dst)
+        profiler.add(copy_function.__name__, wall=time.time() - begin, bytes=size)
+        return src, dst, size, time.time() - begin
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or transfer_jobs) as executor:
+        futures = [executor.submit(copy, src, dst) for src, dst in pairs]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
 def usage(message=None):
-    text = """usage: {this} [-h] [-V] command ...
+    text = """usage: {this} [-h] [-V] [--no-cache] [-y] [-j N] command ...
 
 -h, --help  show this help message and exit
 -V          show program's version number and exit
+--no-cache  ignore and do not update the caches of dependencies in {cache} and of EPS conversions
+-y, --yes   answer "yes" to all the confirmations
+-j N        number of targets processed in parallel with "all" (default: number of CPUs)
+--warm      for archive and JHEP, start from the auxiliary files of the last compile
+--daemon    send the command to the daemon running in this directory
+--plan FILE for push and pull, write the operations to FILE instead of executing them
+--profile   record time spent in each phase into a JSON file
+    --profile-output FILE   the JSON file (default: {cache}/profile.json)
+    --profile-summary       show the profile as a table
 
 available commands:
     {this} compile (texfile)          compile texfile
@@ -102,10 +667,20 @@ available commands:
     {this} JHEP (texfile) suffix      compile and create .tar.gz archive for JHEP
     {this} push (texfile) [suffix]    compile and copy relevant files to the remote directory
     {this} pull (texfile) [suffix]    pull files with <suffix> from the remote directory
+    {this} watch (texfile)            compile texfile whenever it or its dependencies are modified
+    {this} daemon [stop]              start (or stop) a daemon serving commands with --daemon
+    {this} affected [files...]        list targets depending on files (default: files modified since the last build)
+    {this} compile --affected         compile the targets listed by "affected" in parallel
+    {this} versions (texfile)         list the versions saved in the object stores (with "store: true")
+    {this} checkout (texfile) suffix  check out the version with suffix from the object stores
+    {this} gc (texfile)               remove the stored files no longer referred from any version
+    {this} apply plan                 execute the operations written by "push --plan" or "pull --plan"
 
 <texfile> is mandatory if multiple rules are configured.
+For compile, archive, JHEP and push, <texfile> can be "all" (or --all) to process every configured target;
+"push all" runs unattended and thus requires --yes.
 """
-    print(text.format(this=os.path.basename(sys.argv[0])))
+    print(text.format(this=os.path.basename(sys.argv[0]), cache=cache_dir))
     if message:
         error(message)
 
@@ -157,26 +732,70 @@ texfile:   {tex}
     return
 
 
+config_memo = dict()
+
+
+@profiler.profiled
 def read_config():
+    """Return the configurations in ``config_file``, validated.
+
+    The result is cached in ``cache_dir`` (and in ``config_memo``) with the warnings shown during the
+    validation, and reused (with the warnings shown again) while the mtime and size of ``config_file``
+    are unchanged; only the YAML parsing and the checks of the values are skipped, while the paths
+    are checked by ``check_config_paths`` on every call."""
+    try:
+        s = os.stat(config_file)
+    except FileNotFoundError:
+        return dict()
+    key = [version, s.st_mtime_ns, s.st_size]
+    if config_memo.get('key') == key:
+        [warning(text) for text in config_memo['warnings']]
+        return check_config_paths(config_memo['configs'])
+    try:
+        with open(os.path.join(cache_dir, 'config.cache'), 'rb') as f:
+            cache = marshal.load(f)
+        if cache['key'] == key:
+            [warning(text) for text in cache['warnings']]
+            config_memo.update(cache)
+            return check_config_paths(cache['configs'])
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        pass
+
+    warnings = []
+
+    def warn(text):
+        warnings.append(text)
+        warning(text)
+
     def check_config(config):
         if config.get('texfile'):
-            if not os.path.exists(config.get('texfile')):
-                error('config: texfile "{}" not found'.format(config.get('texfile')))
             if not config.get('texfile').endswith('.tex'):
                 error('config: texfile "{}" must have suffix ".tex".'.format(config.get('texfile')))
             config['texfile'] = os.path.expanduser(config['texfile'])
             if os.path.isabs(config['texfile']):
                 error('config: texfile "{}" should not be an absolute path'.format(config.get('texfile')))
         if config.get('remotedir'):
-            config['remotedir'] = os.path.expanduser(config['remotedir']).rstrip(os.path.sep)
-            if not os.path.exists(config['remotedir']):
-                warning('config: remotedir "{}" not found.'.format(config['remotedir']))
+            if isinstance(config['remotedir'], list):
+                if not all(isinstance(d, str) and d for d in config['remotedir']):
+                    error('config: remotedir must be a path or a list of paths.')
+                config['remotedir'] = [os.path.expanduser(d).rstrip(os.path.sep) for d in config['remotedir']]
+            else:
+                config['remotedir'] = os.path.expanduser(config['remotedir']).rstrip(os.path.sep)
+        for item in ['store', 'format']:
+            if config.get(item) is not None and not isinstance(config.get(item), bool):
+                error('config: {} must be true or false.'.format(item))
+        if config.get('engine') is not None and config.get('engine') not in engines:
+            error('config: engine must be one of {}.'.format(', '.join(engines)))
+        if config.get('builddir') is not None and not isinstance(config.get('builddir'), (bool, str)):
+            error('config: builddir must be true, false, or a path.')
+        if config.get('delta') is not None and not isinstance(config.get('delta'), (bool, dict)):
+            error('config: delta must be true, false, or a dict of "min_size" and "extensions".')
         if config.get('extra') and not isinstance(config.get('extra'), list):
             error('config: extra must be a list.')
         if config.get('texfile') is None and config.get('extra') is None:
-            warning('config: "texfile" or "extra" should be specified; nothing happens.')
+            warn('config: "texfile" or "extra" should be specified; nothing happens.')
         if config.get('texfile') is None and config.get('remotedir') is None:
-            warning('config: as "remotedir" is not specified, nothing happens to the "extra" files.')
+            warn('config: as "remotedir" is not specified, nothing happens to the "extra" files.')
 
     configs = dict()
     try:
@@ -193,21 +812,52 @@ def read_config():
                     check_config(i)
                     configs[name] = i
     except FileNotFoundError:
-        pass
+        return configs
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        config_memo.update(key=key, configs=configs, warnings=warnings)
+        write_atomically(os.path.join(cache_dir, 'config.cache'), marshal.dumps(config_memo))
+    except (OSError, ValueError):
+        pass  # not cached, e.g., if the configurations contain objects unsupported by marshal.
+    return check_config_paths(configs)
+
+
+def check_config_paths(configs):
+    """Check the paths in ``configs``, which is done on every run as the files may be (re)moved while
+    the configurations are cached. Return ``configs``."""
+    for config in configs.values():
+        if config.get('texfile') and not os.path.exists(config['texfile']):
+            error('config: texfile "{}" not found'.format(config['texfile']))
+        for d in remotedirs_of(config):
+            if not os.path.exists(d):
+                warning('config: remotedir "{}" not found.'.format(d))
     return configs
 
 
 def parse_args():
     argparser = argparse.ArgumentParser(add_help=False)
     argparser.error = lambda message: usage(message)
-    argparser.add_argument('args', nargs=argparse.REMAINDER)
+    argparser.add_argument('args', nargs='*')
     argparser.add_argument('-h', '--help', action='store_true')
     argparser.add_argument('-V', action='version', version=product_name + ' ' + version)
-    a = argparser.parse_args()
+    argparser.add_argument('--no-cache', action='store_true')
+    argparser.add_argument('-y', '--yes', action='store_true')
+    argparser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+    argparser.add_argument('--all', action='store_true')
+    argparser.add_argument('--warm', action='store_true')
+    argparser.add_argument('--daemon', action='store_true')
+    argparser.add_argument('--affected', action='store_true')
+    argparser.add_argument('--plan')
+    argparser.add_argument('--profile', action='store_true')
+    argparser.add_argument('--profile-output', default=os.path.join(cache_dir, 'profile.json'))
+    argparser.add_argument('--profile-summary', action='store_true')
+    a, unknown = argparser.parse_known_intermixed_args()
+    a.args += unknown  # e.g., a suffix starting with "-"
     if a.help:
         usage()
         sys.exit()
-    return a.args
+    return a
 
 
 def check_latexmk():
@@ -262,28 +912,8 @@ def pdf_from_eps(files):
             f.replace('-eps-converted-to.pdf', '.eps') in files]
 
 
-def get_dependencies(texfile_path, options=list()):
-    """Return files required to compile ``texfile_path``, excluding ``texfile_path`` itself."""
-    print("\n\n" + Color.green('Check dependency of ' + Color.b + texfile_path + Color.g + '.'))
-
-    my_env = os.environ.copy()
-    my_env['BIBINPUTS'] = '.'
-    my_env['BSTINPUTS'] = '.'
-    output, stderr = subprocess.Popen(
-            [latexmk, '-g', '-deps', '-bibtex-', '-interaction=nonstopmode', '-quiet'] + options + [texfile_path],
-            stdout=subprocess.PIPE, env=my_env).communicate()
-
-    begin_tag = '#===Dependents'
-    end_tag = '#===End dependents for '
-    dep = output.decode('utf-8')
-    dep = dep[dep.index(begin_tag):]
-    dep = dep[0:dep.rindex(end_tag)-1]
-    # For begin_tag, exclude zero because it does exist at zero.
-    if dep.rfind(begin_tag) > 0 or dep.find(end_tag) >= 0:
-        error('Dependency cannot be resolved for {}.'.format(texfile_path))
-    dep = dep.splitlines()[2:]  # first two lines are removed
-
-    dep = [x.lstrip("\n\r \t").rstrip("\n\r \t\\") for x in dep]
+def filter_dependencies(dep, texfile_path):
+    """Return sorted local files in ``dep``, excluding ``texfile_path`` and pdf files converted from eps."""
     # remove non-local files
     dep = list(set([os.path.normpath(x) for x in dep if x.find(os.path.sep + 'texmf') == -1]))
     # remove TeX itself
@@ -294,24 +924,317 @@ def get_dependencies(texfile_path, options=list()):
     return sorted(dep, key=lambda x: os.path.splitext(x)[::-1])
 
 
+def read_fls(fls_path):
+    """Return a pair of sets of input and output files recorded in the ``.fls`` file ``fls_path``.
+
+    Paths under the current directory are made relative to it."""
+    inputs, outputs = set(), set()
+    cwd = os.getcwd()
+    pwd = cwd
+    with open(fls_path, 'r', errors='replace') as f:
+        for line in f:
+            tag, _, path = line.rstrip('\n\r').partition(' ')
+            if tag == 'PWD':
+                pwd = path
+                continue
+            path = os.path.normpath(os.path.join(pwd, path))
+            if path.startswith(cwd + os.path.sep):
+                path = os.path.relpath(path, cwd)
+            if tag == 'INPUT':
+                inputs.add(path)
+            elif tag == 'OUTPUT':
+                outputs.add(path)
+    return inputs, outputs
+
+
+def read_fdb(fdb_path):
+    """Return a pair of sets of source and generated files listed in the latexmk database ``fdb_path``."""
+    sources, generated = set(), set()
+    section = None
+    with open(fdb_path, 'r', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('['):
+                section = sources  # a new rule begins with its source files
+            elif line == '(generated)':
+                section = generated
+            elif line.startswith('('):
+                section = None
+            elif line.startswith('"') and section is not None:
+                section.add(os.path.normpath(line.split('"')[1]))
+    return sources, generated
+
+
+@profiler.profiled
+def get_recorded_dependencies(texfile_path, build_dir=None):
+    """Return files required to compile ``texfile_path`` as recorded by the last compile (in ``build_dir``).
+
+    The list is constructed from ``stem.fls`` and ``stem.fdb_latexmk`` (or the state of ``RerunEngine``),
+    and filtered as in ``get_dependencies``. ``None`` is returned if the record is unavailable or outdated."""
+    record = os.path.join(build_dir or '', get_tex_stem(texfile_path))
+    fls_path = record + '.fls'
+    if not os.path.isfile(fls_path):
+        return None
+    inputs, outputs = read_fls(fls_path)
+    if os.path.isfile(record + '.fdb_latexmk'):
+        sources, generated = read_fdb(record + '.fdb_latexmk')
+        inputs |= sources
+        outputs |= generated
+    if os.path.isfile(record + RerunEngine.state_extension):
+        inputs |= set(RerunEngine.load_state(record + RerunEngine.state_extension).get('sources', []))
+    dep = [f for f in inputs - outputs if os.path.splitext(f)[1] not in ['.fmt', '.aux', '.bbl'] and
+           not (build_dir and f.startswith(os.path.normpath(build_dir) + os.path.sep))]
+    # eps files are read by the converter rather than TeX, so are not recorded.
+    dep += [f.replace('-eps-converted-to.pdf', '.eps') for f in dep
+            if f.endswith('-eps-converted-to.pdf') and os.path.exists(f.replace('-eps-converted-to.pdf', '.eps'))]
+
+    # the record is valid only if it is newer than all the local inputs.
+    recorded_at = os.stat(fls_path).st_mtime
+    for f in dep + [texfile_path]:
+        if os.path.isabs(f):
+            continue
+        if not os.path.exists(f) or os.stat(f).st_mtime > recorded_at:
+            return None
+    return filter_dependencies(dep, texfile_path)
+
+
+def cached_dependencies(key):
+    """Return the cached dependency list for ``key`` if all the tracked files are unchanged."""
+    entry = load_cache('dependencies.json').get(key)
+    if not entry:
+        return None
+    try:
+        if any(file_hash(path) != digest for path, digest in entry['hashes'].items()):
+            return None
+    except (OSError, KeyError, AttributeError):
+        return None
+    return entry.get('deps')
+
+
+def store_dependencies(key, texfile_path, deps):
+    """Record ``deps`` for ``key`` together with the content hashes of the files it depends on."""
+    try:
+        hashes = {path: file_hash(path) for path in [texfile_path] + deps}
+    except OSError:
+        return  # some dependencies are not (yet) available; nothing to cache.
+    with cache_lock('dependencies'):
+        cache = load_cache('dependencies.json')
+        cache[key] = {'deps': deps, 'hashes': hashes}
+        save_cache('dependencies.json', cache)
+
+
+@profiler.profiled
+def get_dependencies(texfile_path, options=list(), cache=True):
+    """Return files required to compile ``texfile_path``, excluding ``texfile_path`` itself.
+
+    If ``cache`` (and ``use_cache``), the result is cached in ``cache_dir`` and reused until any
+    of ``texfile_path`` and the dependencies is modified."""
+    cache = cache and use_cache
+    key = json.dumps([texfile_path] + list(options))
+    if cache:
+        deps = cached_dependencies(key)
+        profiler.note(texfile=texfile_path, cached=deps is not None)
+        if deps is not None:
+            print("\n\n" + Color.green('Dependency of ' + Color.b + texfile_path + Color.g + ' is taken from cache.'))
+            return deps
+
+    print("\n\n" + Color.green('Check dependency of ' + Color.b + texfile_path + Color.g + '.'))
+
+    my_env = os.environ.copy()
+    my_env['BIBINPUTS'] = '.'
+    my_env['BSTINPUTS'] = '.'
+    parser = OutputParser()
+    stream_process([latexmk, '-g', '-deps', '-bibtex-', '-interaction=nonstopmode', '-quiet'] + options +
+                   [texfile_path], parser, echo=False, merge_stderr=False, env=my_env)
+    if parser.blocks != 1:
+        parser.report()
+        error('Dependency cannot be resolved for {}.'.format(texfile_path))
+    dep = filter_dependencies(parser.dependencies, texfile_path)
+    if cache:
+        store_dependencies(key, texfile_path, dep)
+    return dep
+
+
+@contextlib.contextmanager
+def cache_lock(name):
+    """Lock ``name`` in ``cache_dir`` exclusively among processes, e.g., children of ``run_all``."""
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, name + '.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def indexed_hash(entry, path):
+    """Return the hash and the status ``[size, mtime]`` of ``path``, where the hash in ``entry`` of the
+    dependency index is reused while the status is unchanged, as ``SyncManifest.hash`` does."""
+    s = os.stat(path)
+    status = [s.st_size, s.st_mtime_ns]
+    if entry.get('stats', {}).get(path) == status and path in entry.get('files', {}):
+        return entry['files'][path], status
+    return file_hash(path), status
+
+
+def update_index(texfile_path, deps):
+    """Record ``deps`` of the target ``texfile_path`` with their hashes in the dependency index, and
+    update the reverse index from each file to the targets depending on it.
+    Only the modified files are read, and the index is not written if nothing is modified."""
+    previous = load_cache('index.json').get('targets', dict()).get(texfile_path, dict())
+    files, stats = dict(), dict()
+    for path in [texfile_path] + [f for f in deps if not os.path.isabs(f)]:
+        try:
+            files[path], stats[path] = indexed_hash(previous, path)
+        except OSError:
+            pass
+    if previous == {'files': files, 'stats': stats}:
+        return
+    with cache_lock('index'):
+        index = load_cache('index.json')
+        targets = index.setdefault('targets', dict())
+        reverse = index.setdefault('reverse', dict())
+        for path in targets.get(texfile_path, {}).get('files', {}):
+            if path not in files and texfile_path in reverse.get(path, []):
+                reverse[path].remove(texfile_path)
+                if not reverse[path]:
+                    del reverse[path]
+        for path in files:
+            if texfile_path not in reverse.setdefault(path, []):
+                reverse[path] = sorted(reverse[path] + [texfile_path])
+        targets[texfile_path] = {'files': files, 'stats': stats}
+        save_cache('index.json', index)
+
+
+def affected_targets(config_list, paths=None):
+    """Return a dict from the targets needing a rebuild to the list of reasons.
+
+    If ``paths`` are given, targets depending on them are returned. Otherwise, targets with any
+    file modified since the last build (or never built) are returned."""
+    index = load_cache('index.json')
+    targets = index.get('targets', dict())
+    result = dict()
+    if paths is not None:
+        for path in paths:
+            for target in index.get('reverse', {}).get(os.path.normpath(path), []):
+                if target in config_list:
+                    result.setdefault(target, []).append(os.path.normpath(path))
+        return result
+    for target, config in config_list.items():
+        if not config.get('texfile'):
+            continue
+        if target not in targets:
+            result[target] = ['(not built yet)']
+            continue
+        for path, digest in targets[target]['files'].items():
+            try:
+                if indexed_hash(targets[target], path)[0] != digest:
+                    result.setdefault(target, []).append(path)
+            except OSError:
+                result.setdefault(target, []).append(path + ' (removed)')
+    return result
+
+
+def strip_tex_comments(text):
+    """Return ``text`` with TeX comments removed."""
+    return re.sub(r'(?<!\\)%.*', '', text)
+
+
+tex_reference_pattern = re.compile(
+    r'\\(input|include|includegraphics|graphicspath|bibliography|addbibresource|bibliographystyle|'
+    r'usepackage|RequirePackage|documentclass|LoadClass)\*?\s*(?:\[[^\]]*\]\s*)*'
+    r'(?:\{((?:[^{}]|\{[^{}]*\})*)\}|(?<=input)\s+([^\s{}\\]+))')
+graphics_extensions = ['.pdf', '.png', '.jpg', '.mps', '.jpeg', '.jbig2', '.jb2',
+                       '.PDF', '.PNG', '.JPG', '.JPEG', '.JBIG2', '.JB2', '.eps']
+
+
+@profiler.profiled
+def scan_dependencies(texfile_path):
+    """Return local files referred from ``texfile_path`` recursively, found by a static scan of the sources.
+
+    ``\\input``, ``\\include``, ``\\includegraphics`` (with ``\\graphicspath``), ``\\bibliography``,
+    ``\\addbibresource``, ``\\bibliographystyle``, ``\\usepackage`` and ``\\documentclass`` are followed
+    if the referred files exist in the current directory. The result may be incomplete, e.g., for files
+    referred through macros, so it should be verified by ``get_dependencies``."""
+    found = []
+    graphics_paths = ['']
+
+    def first_existing(candidates):
+        for path in candidates:
+            path = os.path.normpath(path)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def resolve(command, name):
+        if command in ['input', 'include']:
+            return first_existing([name + '.tex'] if command == 'include' else [name, name + '.tex'])
+        elif command == 'includegraphics':
+            candidates = []
+            for d in graphics_paths:
+                base = os.path.join(d, name)
+                candidates += [base] + [base + ext for ext in graphics_extensions]
+            return first_existing(candidates)
+        elif command == 'bibliography':
+            return first_existing([name + '.bib', name])
+        elif command == 'addbibresource':
+            return first_existing([name])
+        elif command == 'bibliographystyle':
+            return first_existing([name + '.bst'])
+        elif command in ['usepackage', 'RequirePackage']:
+            return first_existing([name + '.sty'])
+        elif command in ['documentclass', 'LoadClass']:
+            return first_existing([name + '.cls'])
+
+    def scan(path):
+        try:
+            with open(path, 'r', errors='replace') as f:
+                text = strip_tex_comments(f.read())
+        except OSError:
+            return
+        for command, braced, bare in tex_reference_pattern.findall(text):
+            if command == 'graphicspath':
+                graphics_paths.extend(re.findall(r'\{([^{}]*)\}', braced))
+                continue
+            names = [braced] if command in ['input', 'include', 'includegraphics'] else braced.split(',')
+            for name in names if braced else [bare]:
+                dep = resolve(command, name.strip())
+                if dep and dep != texfile_path and dep not in found:
+                    found.append(dep)
+                    if os.path.splitext(dep)[1] in ['.tex', '.sty', '.cls']:
+                        scan(dep)
+
+    scan(texfile_path)
+    return found
+
+
+@profiler.profiled
 def get_and_collect_dependencies(orig_texfile_path, target_dir, new_texfile_path):
     """
     Return files required to compile ``orig_texfile_path`` relative to ``cwd``.
     During the process the TeX file is copied to ``target_dir``/``new_texfile_path``
     and files required to compile are collected to ``target_dir``.
+
+    The files are first collected by ``scan_dependencies`` and then verified by a single
+    ``get_dependencies`` call in ``target_dir``, which is repeated only if files are still missing.
     """
     if not new_texfile_path.endswith('.tex'):
         raise RuntimeError('get_anc_collect_dependencies: new_texfile_path should have ".tex" extention.')
 
-    # First trial is done using 'outdir' so that TeX file search correctly works.
     copy_with_mkdir(orig_texfile_path, os.path.join(target_dir, new_texfile_path))
-    deps = get_dependencies(orig_texfile_path, ['-outdir=' + target_dir, '-jobname=' + new_texfile_path[0:-4]])
+    deps = scan_dependencies(orig_texfile_path)
+    for f in deps:
+        if os.path.isabs(f) or os.path.normpath(f).startswith(os.pardir + os.sep):
+            warning('This TeX depends on {}, which is not archived.'.format(f))
+            continue
+        copy_with_mkdir(f, os.path.join(target_dir, f))
+    if use_cache:
+        with cd(target_dir):
+            seed_eps_conversions([f for f in deps if f.endswith('.eps')])
 
     for trial in range(0, 10):
         with cd(target_dir):
-            if trial != 0:
-                # update dependency, but now simply invoke at the target dir.
-                deps = get_dependencies(new_texfile_path)
+            deps = get_dependencies(new_texfile_path, cache=False)
             deps_to_copy = [f for f in deps if not os.path.exists(f)]
 
         retry = False
@@ -330,8 +1253,12 @@ def get_and_collect_dependencies(orig_texfile_path, target_dir, new_texfile_path
     error('Dependency not solved.')
 
 
-def compare_files_and_get_mode(src, dst):
-    """Compare files, assuming ``src`` and ``dst`` are existing files."""
+@profiler.profiled(total=True)
+def compare_files_and_get_mode(src, dst, manifest=None):
+    """Compare files, assuming ``src`` and ``dst`` are existing files.
+    If ``manifest`` is given, the comparison is delegated to it."""
+    if manifest is not None:
+        return manifest.mode(src, dst)
     if not os.path.lexists(dst):
         return 'create'
     abort_if_not_file(dst, allow_symlink=True)
@@ -344,41 +1271,988 @@ def compare_files_and_get_mode(src, dst):
         return 'conflict'
 
 
+class RemoteIndex:
+    """Entries of the directories under ``root`` read by ``os.scandir`` once for each directory, which answer
+    the queries on the status of the remote files, as each system call may be a round trip on a network
+    file system or a FUSE-based sync folder. ``prefetch`` reads the directories concurrently."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.dirs = dict()  # directory => {name: os.DirEntry}, or None if not a directory
+
+    def entries(self, directory):
+        directory = os.path.abspath(directory)
+        if directory not in self.dirs:
+            try:
+                with os.scandir(directory) as it:
+                    self.dirs[directory] = {e.name: e for e in it}
+            except (FileNotFoundError, NotADirectoryError):
+                self.dirs[directory] = None
+        return self.dirs[directory]
+
+    def entry(self, path):
+        entries = self.entries(os.path.dirname(os.path.abspath(path)))
+        entry = entries and entries.get(os.path.basename(path))
+        if not entry:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return entry
+
+    def lstat(self, path):
+        return self.entry(path).stat(follow_symlinks=False)
+
+    def stat(self, path):
+        return self.entry(path).stat()
+
+    def isfile(self, path):
+        try:
+            return self.entry(path).is_file()
+        except OSError:
+            return False
+
+    def files(self, directory):
+        """Return the names of the files in ``directory``."""
+        return sorted(name for name, e in (self.entries(directory) or dict()).items() if e.is_file())
+
+    def invalidate(self, path):
+        """Forget the directory of ``path``, e.g., after the file is written."""
+        self.dirs.pop(os.path.dirname(os.path.abspath(path)), None)
+
+    def prefetch(self, paths):
+        """Read the directories of ``paths`` and the status of ``paths`` concurrently in ``transfer_jobs`` threads."""
+        def read(directory, names):
+            entries = self.entries(directory) or dict()
+            for name in names:
+                if name in entries:
+                    entries[name].stat(follow_symlinks=False)  # cached in the entry
+
+        wanted = dict()
+        for path in paths:
+            wanted.setdefault(os.path.dirname(os.path.abspath(path)), []).append(os.path.basename(path))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=transfer_jobs) as executor:
+            futures = [executor.submit(read, d, names) for d, names in wanted.items() if d not in self.dirs]
+            [f.result() for f in futures]
+
+
+class SyncManifest:
+    """Records of files synced between the current directory and ``remotedir_path``.
+
+    The remote records are saved as ``manifest_file`` in ``remotedir_path`` only by the operations
+    copying files there, so that pulls never write to the shared folder, and are also cached in
+    ``cache_dir`` with the local ones. Each record holds size, mtime, and hash of the file, where the hash is reused
+    while size and mtime are unchanged, and the hash of the last synced version (``synced``),
+    with which modifications on each side are detected."""
+
+    def __init__(self, remotedir_path):
+        self.remotedir = os.path.abspath(remotedir_path)
+        self.index = RemoteIndex(self.remotedir)
+        self.remote = dict(load_cache('manifest-remote.json').get(self.remotedir, dict()), **self.load_remote())
+        self.local = load_cache('manifest.json').get(self.remotedir, dict())
+        self.touched = {'remote': set(), 'local': set()}
+        self.copied = False  # whether files are copied into ``remotedir``
+        self.unshared = set()  # keys of the remote records not yet saved in ``remotedir``
+
+    def load_remote(self):
+        try:
+            with open(os.path.join(self.remotedir, manifest_file), 'r') as f:
+                content = json.load(f)
+            return content if isinstance(content, dict) else dict()
+        except (OSError, ValueError):
+            return dict()
+
+    def locate(self, path):
+        """Return the side (``'remote'`` or ``'local'``) and the key of ``path``."""
+        path = os.path.abspath(path)
+        if path.startswith(self.remotedir + os.path.sep):
+            return 'remote', os.path.relpath(path, self.remotedir)
+        return 'local', os.path.relpath(path)
+
+    def entry(self, path):
+        side, key = self.locate(path)
+        self.touched[side].add(key)
+        return (self.remote if side == 'remote' else self.local).setdefault(key, dict())
+
+    def stat(self, path, follow_symlinks=True):
+        """Return the status of ``path``, taken from ``index`` for remote files."""
+        if self.locate(path)[0] == 'remote':
+            return self.index.stat(path) if follow_symlinks else self.index.lstat(path)
+        return os.stat(path, follow_symlinks=follow_symlinks)
+
+    def hash(self, path):
+        """Return the hash of ``path``, reading the content only if the record is stale."""
+        s = self.stat(path)
+        entry = self.entry(path)
+        if entry.get('size') != s.st_size or entry.get('mtime') != s.st_mtime_ns or not entry.get('hash'):
+            entry.update(size=s.st_size, mtime=s.st_mtime_ns, hash=file_hash(path))
+        return entry['hash']
+
+    def mode(self, src, dst):
+        """Return the mode to sync ``src`` to ``dst``; see ``compare_files_and_get_mode``."""
+        try:
+            s = self.stat(dst, follow_symlinks=False)
+        except FileNotFoundError:
+            return 'create'
+        if stat.S_ISDIR(s.st_mode):
+            error('{} exists as a directory.'.format(dst))
+        elif not (stat.S_ISREG(s.st_mode) or stat.S_ISLNK(s.st_mode)):
+            raise RuntimeError('{} cannot be identified.'.format(dst))
+        src_hash, dst_hash = self.hash(src), self.hash(dst)
+        if src_hash == dst_hash:
+            self.entry(src)['synced'] = self.entry(dst)['synced'] = src_hash
+            return 'ignore'
+        if stat.S_ISLNK(s.st_mode):
+            error('{} exists as a symlink.'.format(dst))
+        synced = self.entry(src).get('synced')
+        if synced and synced == self.entry(dst).get('synced'):
+            # three-way comparison: dst must be unmodified since the last sync.
+            return 'update' if dst_hash == synced else 'conflict'
+        if self.stat(src).st_mtime > s.st_mtime:
+            return 'update'
+        else:
+            return 'conflict'
+
+    def record(self, src, dst):
+        """Record that ``src`` is copied to ``dst``."""
+        src_hash = self.hash(src)
+        self.copied = self.copied or self.locate(dst)[0] == 'remote'
+        self.index.invalidate(dst)
+        s = os.stat(dst)
+        self.entry(dst).update(size=s.st_size, mtime=s.st_mtime_ns, hash=src_hash)
+        self.entry(src)['synced'] = self.entry(dst)['synced'] = src_hash
+
+    def save(self):
+        """Save the records, merged into the latest ones on each side."""
+        with cache_lock('manifest'):
+            if self.touched['remote']:
+                entries = {k: self.remote[k] for k in self.touched['remote']}
+                self.unshared |= self.touched['remote']
+                if self.copied and os.path.isdir(self.remotedir):
+                    remote = self.load_remote()
+                    remote.update({k: self.remote[k] for k in self.unshared})
+                    write_json(os.path.join(self.remotedir, manifest_file), remote)
+                    self.unshared = set()
+                cache = load_cache('manifest-remote.json')
+                cache.setdefault(self.remotedir, dict()).update(entries)
+                save_cache('manifest-remote.json', cache)
+            if self.touched['local']:
+                cache = load_cache('manifest.json')
+                cache.setdefault(self.remotedir, dict()).update({k: self.local[k] for k in self.touched['local']})
+                save_cache('manifest.json', cache)
+        self.touched = {'remote': set(), 'local': set()}
+
+
+class ObjectStore:
+    """Content-addressed store of files in the directory ``path``.
+
+    Each content is stored once as ``objects/ab/cdef...`` named by its SHA-256 hash, and each version,
+    i.e., a push or an archive with a suffix, is a small tree manifest ``trees/NAME.json`` mapping
+    paths to the hashes, so that versions sharing most of their files take little space. Objects are
+    stored and materialized as independent files by reflink or copy; never by hard link, as the files
+    may be edited in place, e.g., by co-authors in a shared folder. Thus the objects share the blocks
+    with the files only on file systems supporting reflinks, and are otherwise a history kept in
+    addition to the files. The objects are read-only."""
+    FICLONE = 0x40049409
+
+    def __init__(self, path):
+        self.path = path
+        self.methods = ['reflink', 'copy']
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[0:2], digest[2:])
+
+    def tree_path(self, name):
+        return os.path.join(self.path, 'trees', name + '.json')
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        """Lock the store; ``gc`` locks exclusively while versions are written under shared locks."""
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def put(self, path):
+        """Store the content of ``path`` unless stored, and return its hash."""
+        digest = file_hash(path)
+        obj = self.object_path(digest)
+        if not os.path.exists(obj):
+            self.clone(path, obj)
+            os.chmod(obj, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        return digest
+
+    def materialize(self, digest, dst):
+        """Replace ``dst`` atomically with a writable file of the content ``digest``. Return the method used."""
+        return self.clone(self.object_path(digest), dst)
+
+    def clone(self, src, dst):
+        """Replace ``dst`` atomically with a writable copy of ``src``, by reflink or copy in this order of
+        preference. Return the method used."""
+        dirname = os.path.dirname(dst)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = os.path.join(dirname, '.{}.{}-{}'.format(os.path.basename(dst), os.getpid(), threading.get_ident()))
+        for method in list(self.methods):
+            try:
+                with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                    if method == 'reflink':
+                        fcntl.ioctl(fdst.fileno(), self.FICLONE, fsrc.fileno())
+                    else:
+                        copy_content(fsrc.fileno(), fdst.fileno(), os.fstat(fsrc.fileno()).st_size)
+                shutil.copystat(src, tmp)
+                os.chmod(tmp, stat.S_IMODE(os.stat(tmp).st_mode) | stat.S_IWUSR)
+                os.replace(tmp, dst)
+                return method
+            except OSError as e:
+                remove_file(tmp)
+                if method == 'copy':
+                    raise
+                if method in self.methods and e.errno != errno.EXDEV:
+                    self.methods.remove(method)  # unsupported by the file system; not tried again.
+
+    def install(self, src, dst):
+        """Store ``src`` and materialize it as ``dst``. Return the size; used as a copy function."""
+        self.materialize(self.put(src), dst)
+        return os.stat(dst).st_size
+
+    def write_tree(self, name, files, **info):
+        """Save the version ``name`` consisting of ``files``, a dict of paths to hashes."""
+        content = dict(info, name=name, created=time.strftime('%Y-%m-%d %H:%M:%S'), files=files)
+        path = self.tree_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json(path, content)
+
+    def read_tree(self, name):
+        try:
+            with open(self.tree_path(name), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def trees(self):
+        """Return the list of the versions."""
+        try:
+            names = os.listdir(os.path.join(self.path, 'trees'))
+        except FileNotFoundError:
+            return []
+        return [t for t in (self.read_tree(n[0:-5]) for n in sorted(names) if n.endswith('.json')) if t]
+
+    def ingest(self, name, directory, **info):
+        """Store the files in ``directory`` as the version ``name``, leaving the files as they are."""
+        files = dict()
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files[os.path.relpath(path, directory)] = self.put(path)
+        self.write_tree(name, files, **info)
+        return files
+
+    def checkout(self, name, directory):
+        """Materialize the version ``name`` into ``directory`` as writable copies."""
+        tree = self.read_tree(name)
+        for path, digest in sorted(tree['files'].items()):
+            self.materialize(digest, os.path.join(directory, path))
+        return tree
+
+    def size(self, digest):
+        try:
+            return os.stat(self.object_path(digest)).st_size
+        except OSError:
+            return 0
+
+    def gc(self):
+        """Remove the objects referred from no version. Return the number and the total size of them."""
+        with self.lock(exclusive=True):
+            referred = set()
+            for tree in self.trees():
+                referred.update(tree.get('files', dict()).values())
+            removed, freed = 0, 0
+            objects = os.path.join(self.path, 'objects')
+            for prefix in (sorted(os.listdir(objects)) if os.path.isdir(objects) else []):
+                for rest in os.listdir(os.path.join(objects, prefix)):
+                    if prefix + rest not in referred:
+                        path = os.path.join(objects, prefix, rest)
+                        freed += os.stat(path).st_size
+                        os.remove(path)
+                        removed += 1
+                if not os.listdir(os.path.join(objects, prefix)):
+                    os.rmdir(os.path.join(objects, prefix))
+        return removed, freed
+
+
+def remotedirs_of(config):
+    """Return the list of the remote directories of ``config``, where "remotedir" is a path or a list."""
+    remotedir = config.get('remotedir')
+    if not remotedir:
+        return []
+    return list(remotedir) if isinstance(remotedir, list) else [remotedir]
+
+
+def stores_of(config):
+    """Return a dict of the object stores of ``config``, i.e., the local one for archives and the remote ones."""
+    stores = {'local': ObjectStore(os.path.join(cache_dir, 'store'))}
+    for remotedir_path in remotedirs_of(config):
+        stores[remotedir_path] = ObjectStore(os.path.join(remotedir_path, store_dir))
+    return stores
+
+
 # 'path' means full-path from a base (usually the currrent) directory to the file/dir.
 # 'stem' is a basename of file, with no dir, and no "extension".
 # 'name' is a basename of file including extension, and possibly with dir.
 
-def compile_tex(config, remove_misc=False, quiet=False):
-    check_latexmk()
+@functools.lru_cache(maxsize=None)
+def engine_version(program):
+    """Return the version of ``program`` with the path, size, and mtime of the executable, which tell the
+    formats made by other executables, e.g., before an update of TeX Live; '' if ``program`` is not found."""
+    path = shutil.which(program)
+    if path is None:
+        return ''
+    path = os.path.realpath(path)
+    s = os.stat(path)
+    try:
+        banner = run_process([path, '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True).stdout
+    except OSError:
+        banner = ''
+    return '{}\0{}\0{}\0{}'.format(path, s.st_size, s.st_mtime_ns, banner)
+
+
+def preamble_key(texfile_path, program=pdflatex):
+    """Return the hash of the preamble of ``texfile_path`` for ``program`` (and its version) and the local
+    packages and classes, or None if ``\\begin{document}`` is not found."""
+    with open(texfile_path, 'r', errors='replace') as f:
+        text = f.read()
+    end = text.find('\\begin{document}')
+    if end < 0:
+        return None
+    h = hashlib.sha256((program + '\0' + engine_version(program) + '\0' + text[0:end]).encode())
+    for f in sorted(f for f in scan_dependencies(texfile_path) if f.endswith(('.sty', '.cls'))):
+        h.update('\0{}\0{}'.format(f, file_hash(f)).encode())
+    return h.hexdigest()
+
+
+@profiler.profiled
+def preamble_format(texfile_path, program=pdflatex):
+    """Return the path (without extension) of the format for ``program`` with the preamble of ``texfile_path``
+    precompiled by mylatexformat, built if not cached in ``format_dir``, or None if unavailable."""
+    key = preamble_key(texfile_path, program)
+    if key is None:
+        warning('\\begin{document} not found in ' + texfile_path + '; the preamble is not precompiled.')
+        return None
+    stem = get_tex_stem(texfile_path)
+    name = stem + '-' + key[0:16]
+    path = os.path.abspath(os.path.join(format_dir, name))
+    if os.path.isfile(path + '.fmt'):
+        profiler.add('format_cache', hit=1)
+        return path
+    profiler.add('format_cache', miss=1)
+
+    print('\n\n' + Color.green('Precompile the preamble of ' + Color.b + texfile_path + Color.g + '.'))
+    os.makedirs(format_dir, exist_ok=True)
+    returncode = run_process(
+        [program, '-ini', '-interaction=batchmode', '-jobname=' + name, '-output-directory=' + format_dir,
+         '&' + os.path.basename(program), 'mylatexformat.ltx', texfile_path],
+        stdout=subprocess.DEVNULL).returncode
+    if returncode != 0 or not os.path.isfile(path + '.fmt'):
+        warning('the preamble is not precompiled; see {}.'.format(os.path.join(format_dir, name + '.log')))
+        return None
+    for f in os.listdir(format_dir):  # formats of the older preambles
+        if re.fullmatch(re.escape(stem) + r'-[0-9a-f]{16}\.\w+', f) and not f.startswith(name + '.'):
+            remove_file(os.path.join(format_dir, f))
+    return path
+
+
+engines = ['latexmk', 'pdflatex', 'lualatex', 'xelatex']
+artifact_extensions = ['.pdf', '.bbl', '.ax2']
+
+
+def build_dir_of(config):
+    """Return the build directory of ``config``, where "builddir" is a path or true for the default
+    ``cache_dir/build/TEXFILE`` (without ``.tex``), or None if the build is in the current directory."""
+    builddir = config.get('builddir')
+    if not builddir:
+        return None
+    if builddir is True:
+        return os.path.join(cache_dir, 'build', config['texfile'][0:-4])
+    return os.path.normpath(os.path.expanduser(builddir))
+
+
+def prepare_build_dir(texfile_path, build_dir):
+    """Create ``build_dir`` with the subdirectories for the ``.aux`` files of the ``\\include``'d files."""
+    os.makedirs(build_dir, exist_ok=True)
+    for f in scan_dependencies(texfile_path):
+        if f.endswith('.tex') and os.path.dirname(f) and not os.path.isabs(f):
+            os.makedirs(os.path.join(build_dir, os.path.dirname(f)), exist_ok=True)
+
+
+def publish_artifacts(texfile_stem, build_dir):
+    """Copy the artifacts (``artifact_extensions``) from ``build_dir`` to the current directory,
+    each replaced atomically, unless they are unchanged."""
+    for ext in artifact_extensions:
+        src = os.path.join(build_dir, texfile_stem + ext)
+        if not os.path.isfile(src):
+            continue
+        s = os.stat(src)
+        try:
+            d = os.stat(texfile_stem + ext)
+            if (d.st_size, d.st_mtime_ns) == (s.st_size, s.st_mtime_ns):
+                continue
+        except FileNotFoundError:
+            pass
+        copy_atomically(src, texfile_stem + ext)
+
+
+def clean_outputs(texfile_stem, directory, keep=list()):
+    """Remove the files generated by the last compile of ``texfile_stem`` in ``directory`` except ``keep``.
+
+    The files are taken from the recorder (``.fls``) and the latexmk database, in place of ``latexmk -CA``."""
+    record = os.path.join(directory, texfile_stem)
+    outputs = {record + ext for ext in ['.fls', '.fdb_latexmk', '.log', '.blg', '.ilg', '.glg', '.bcf',
+                                        '.run.xml', RerunEngine.state_extension]}
+    if os.path.isfile(record + '.fls'):
+        outputs |= read_fls(record + '.fls')[1]
+    if os.path.isfile(record + '.fdb_latexmk'):
+        outputs |= read_fdb(record + '.fdb_latexmk')[1]
+    keep = [os.path.normpath(os.path.join(directory, f)) for f in keep]
+    for path in sorted(os.path.normpath(f) for f in outputs):
+        if not (os.path.isabs(path) or path.startswith('..') or path.endswith('.tex') or path in keep):
+            remove_file(path)
+
+
+@profiler.profiled
+def compile_tex(config, remove_misc=False, quiet=False, abort=True):
+    """Compile ``config['texfile']`` by latexmk or ``RerunEngine`` (see ``engines``), in the build directory
+    if configured, from which the artifacts are published to the current directory.
+    If ``remove_misc``, the generated files other than the artifacts are removed afterward.
+    On a fatal error of TeX, exit if ``abort``, and otherwise return False; return True if compiled."""
     texfile_path = config['texfile']
     texfile_stem = get_tex_stem(texfile_path)
+    engine = config.get('engine') or 'latexmk'
+    build_dir = build_dir_of(config)
+    if engine == 'latexmk':
+        check_latexmk()
+    elif not shutil.which(engine):
+        error('{} not found.'.format(engine))
 
     cwd = os.getcwd()
-    print('\n\n' + Color.green('Compile ' + texfile_path + ' in ' + Color.b + cwd + Color.g + '.'))
-    process = [latexmk, '-pdf', '-quiet', texfile_path]
-    if not quiet:
-        process.pop(2)
-    subprocess.Popen(process).communicate()
+    print('\n\n' + Color.green('Compile ' + texfile_path + ' in ' + Color.b + (build_dir or cwd) + Color.g + '.'))
+    fmt = preamble_format(texfile_path, pdflatex if engine == 'latexmk' else engine) if config.get('format') else None
+    eps_files = [f for f in scan_dependencies(texfile_path) if f.endswith('.eps')] if use_cache else []
+    seed_eps_conversions(eps_files)
+    if build_dir:
+        prepare_build_dir(texfile_path, build_dir)
+    if engine == 'latexmk':
+        # the output of TeX is parsed even if ``quiet``, where it is not shown.
+        process = [latexmk, '-pdf', '-recorder', '-interaction=nonstopmode', '-file-line-error', texfile_path]
+        if fmt:
+            process.insert(-1, '-pdflatex={} -fmt="{}" %O %S'.format(pdflatex, fmt))
+        if build_dir:
+            process.insert(-1, '-outdir=' + build_dir)
+        parser = OutputParser()
+        returncode = stream_process(process, parser, echo=not quiet)
+        parser.report()
+        if returncode:
+            warning('{} exited with code {}.'.format(latexmk, returncode))
+    else:
+        returncode = RerunEngine(texfile_path, engine, build_dir or '.', fmt=fmt).run(quiet=quiet)
+    if returncode is None:
+        message = 'Compile of {} is aborted on a fatal error.'.format(texfile_path)
+        if abort:
+            error(message)
+        print(Color.red('\n[ERROR] ' + message))
+        return False
+    store_eps_conversions(eps_files)
+    if build_dir:
+        publish_artifacts(texfile_stem, build_dir)
 
     if remove_misc:
-        print("\n\n" + Color.green('Unnecessary files in ' + Color.b + cwd + Color.g + ' are removed.'))
-        tempdir = tempfile.mkdtemp()
-        shelters = {}
-        # pdf and bbl are created in current dirrectory.
-        for ext in ['.pdf', '.bbl', '.ax2']:
-            src = os.path.join(texfile_stem + ext)
-            dst = os.path.join(tempdir, src)
-            if os.path.exists(src):
-                shelters[src] = dst
-        for src in shelters.keys():
-            shutil.move(src, tempdir)
-        subprocess.Popen([latexmk, '-CA', texfile_path]).communicate()
-        for dst in shelters.values():
-            shutil.move(dst, '.')
-        os.rmdir(tempdir)
-
-
-def archive(config, suffix, style=None):
+        print("\n\n" + Color.green('Unnecessary files in ' + Color.b + (build_dir or cwd) + Color.g + ' are removed.'))
+        clean_outputs(texfile_stem, build_dir or '.', keep=[texfile_stem + ext for ext in artifact_extensions])
+    return True
+
+
+engine_aux_extensions = ['.aux', '.toc', '.lof', '.lot', '.out', '.nav', '.snm', '.vrb',
+                         '.bbl', '.ind', '.gls', '.brf']
+engine_max_passes = 6
+
+
+class RerunEngine:
+    """A replacement of latexmk, running ``program`` (pdflatex, lualatex, or xelatex), bibtex or biber,
+    and makeindex with the outputs in ``outdir``.
+
+    Each pass is followed by bibtex (or biber) only if the citations in the ``.aux`` files (or the
+    ``.bcf`` file) or the databases are modified, and by makeindex only if the ``.idx`` file is
+    modified. The passes are repeated until the auxiliary files (``engine_aux_extensions`` and the
+    ``.aux`` files of ``\\include``'d files) reach a fixed point. The inputs of the last build are
+    kept in ``stem.runtex-engine.json``, and nothing is run while they are unchanged."""
+    state_extension = '.runtex-engine.json'
+
+    def __init__(self, texfile_path, program, outdir='.', fmt=None):
+        self.texfile = texfile_path
+        self.program = program
+        self.outdir = outdir
+        self.stem = get_tex_stem(texfile_path)
+        self.command = [program, '-interaction=nonstopmode', '-file-line-error', '-recorder',
+                        '-output-directory=' + outdir]
+        if fmt:
+            self.command.append('-fmt=' + fmt)
+        self.command.append(texfile_path)
+        self.state = self.load_state(self.out(self.state_extension))
+
+    def out(self, ext):
+        return os.path.join(self.outdir, self.stem + ext)
+
+    @staticmethod
+    def load_state(path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def save_state(self):
+        write_json(self.out(self.state_extension), self.state)
+
+    def read(self, path):
+        try:
+            with open(path, 'r', errors='replace') as f:
+                return f.read()
+        except OSError:
+            return ''
+
+    def aux_files(self):
+        included = re.findall(r'\\@input\{([^{}]*)\}', self.read(self.out('.aux')))
+        return [self.out(ext) for ext in engine_aux_extensions] + [os.path.join(self.outdir, f) for f in included]
+
+    @staticmethod
+    def digest(path):
+        """Return the hash of ``path`` (or None if absent), not memorized in ``hash_memo`` as the
+        auxiliary files may be rewritten within a tick of mtime."""
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def snapshot(self):
+        return {path: self.digest(path) for path in self.aux_files()}
+
+    def bibliography(self):
+        """Return the tool (bibtex or biber), the key to detect modifications, and the database and style files
+        of the bibliography of the last pass, or None if no bibliography is used."""
+        if os.path.isfile(self.out('.bcf')):
+            text = self.read(self.out('.bcf'))
+            tool = 'biber'
+            sources = re.findall(r'<bcf:datasource[^>]*>([^<]*)</bcf:datasource>', text)
+        else:
+            tool = 'bibtex'
+            text = ''
+            sources = []
+            for aux in [self.out('.aux')] + self.aux_files()[len(engine_aux_extensions):]:
+                lines = re.findall(r'^\\(?:citation|bibdata|bibstyle)\{.*\}$', self.read(aux), re.MULTILINE)
+                text += '\n'.join(lines) + '\n'
+                for line in lines:
+                    names = [n.strip() for n in line[line.index('{') + 1:-1].split(',')]
+                    if line.startswith('\\bibdata'):
+                        sources += [n if n.endswith('.bib') else n + '.bib' for n in names]
+                    elif line.startswith('\\bibstyle'):
+                        sources += [n + '.bst' for n in names]
+            if '\\bibdata{' not in text:
+                return None
+        sources = sorted(set(f for f in sources if os.path.isfile(f)))
+        h = hashlib.sha256(text.encode())
+        for f in sources:
+            h.update('\0{}\0{}'.format(f, file_hash(f)).encode())
+        return tool, h.hexdigest(), sources
+
+    def run_tool(self, name, args, quiet):
+        env = os.environ.copy()
+        for var in ['BIBINPUTS', 'BSTINPUTS']:  # the tools run in outdir but read the files in the current directory.
+            env[var] = os.getcwd() + os.pathsep + env.get(var, '')
+        if run_process([name] + args, cwd=self.outdir, env=env,
+                       stdout=subprocess.DEVNULL if quiet else None).returncode not in [0, 1]:
+            warning('{} failed; see the log in {}.'.format(name, self.outdir))
+
+    def modified_inputs(self):
+        """Return the list of the inputs modified since the last build, or None if unknown."""
+        if (self.state.get('command') != self.command or 'inputs' not in self.state or
+                not os.path.isfile(self.out('.pdf'))):
+            return None
+        modified = []
+        for path, digest in self.state['inputs'].items():
+            try:
+                if file_hash(path) != digest:
+                    modified.append(path)
+            except OSError:
+                modified.append(path)
+        return modified
+
+    def record_inputs(self, sources):
+        inputs, outputs = read_fls(self.out('.fls'))
+        inputs = [f for f in (inputs - outputs) | set(sources) if not os.path.isabs(f) and os.path.isfile(f)]
+        self.state.update(command=self.command, sources=sources, inputs={f: file_hash(f) for f in inputs})
+
+    @profiler.profiled
+    def run(self, quiet=False):
+        """Build the PDF, and return the number of passes, or None if aborted on a fatal error."""
+        modified = self.modified_inputs()
+        if modified == []:
+            print(Color.green('All the inputs are unchanged since the last build.'))
+            profiler.note(passes=0)
+            return 0
+        reasons = ['modified ' + ', '.join(modified) if modified else 'no previous build']
+        before = self.snapshot()
+        sources = []
+        passes = 0
+        while reasons:
+            if passes == engine_max_passes:
+                warning('the auxiliary files do not converge in {} passes.'.format(passes))
+                break
+            passes += 1
+            print(Color.green('Pass {} ({}): '.format(passes, self.program)) + '; '.join(reasons))
+            parser = OutputParser()
+            returncode = stream_process(self.command, parser, echo=not quiet)
+            if returncode != 0:
+                parser.report()
+                warning('{} failed; see {}.'.format(self.program, self.out('.log')))
+                self.state.pop('inputs', None)
+                self.save_state()
+                return None if returncode is None else passes
+            reasons = []
+
+            bibliography = self.bibliography()
+            if bibliography:
+                tool, key, sources = bibliography
+                if key != self.state.get('bibliography') or not os.path.isfile(self.out('.bbl')):
+                    self.run_tool(tool, [self.stem], quiet)  # in outdir, where the .aux / .bcf file is
+                    self.state['bibliography'] = key
+            if os.path.isfile(self.out('.idx')):
+                key = self.digest(self.out('.idx'))
+                if key != self.state.get('index') or not os.path.isfile(self.out('.ind')):
+                    self.run_tool('makeindex', ['-q', self.stem + '.idx'], quiet)
+                    self.state['index'] = key
+
+            after = self.snapshot()
+            changed = [os.path.relpath(f, self.outdir) for f in after if after[f] != before.get(f)]
+            if changed:
+                reasons.append('modified ' + ', '.join(changed))
+            before = after
+
+        parser.report()  # undefined references remaining after the last pass
+        self.record_inputs(sources)
+        self.save_state()
+        print(Color.green('{} in {} pass{}.'.format(self.out('.pdf'), passes, '' if passes == 1 else 'es')))
+        profiler.note(passes=passes)
+        return passes
+
+
+eps_cache_limit = 500 * 1000 * 1000
+epstopdf_command = 'epstopdf'
+
+
+def eps_cache_path():
+    """Return the directory of the PDF files converted from EPS files, shared among projects."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'runtex', 'eps')
+
+
+def eps_cache_entry(eps_path):
+    """Return the path of the conversion of ``eps_path`` in the cache, keyed by the content and the converter."""
+    key = hashlib.sha256('{}\0{}'.format(file_hash(eps_path), epstopdf_command).encode()).hexdigest()
+    return os.path.join(eps_cache_path(), key[0:2], key[2:] + '.pdf')
+
+
+def eps_converted_path(eps_path):
+    return eps_path[0:-4] + '-eps-converted-to.pdf'
+
+
+def is_converted(eps_path):
+    pdf = eps_converted_path(eps_path)
+    return os.path.isfile(pdf) and os.stat(pdf).st_mtime >= os.stat(eps_path).st_mtime
+
+
+@profiler.profiled
+def seed_eps_conversions(eps_files):
+    """Place the cached conversions of ``eps_files`` next to them, so that epstopdf is skipped."""
+    seeded = 0
+    for eps in eps_files:
+        if is_converted(eps):
+            continue
+        entry = eps_cache_entry(eps)
+        try:
+            copy_atomically(entry, eps_converted_path(eps))
+        except FileNotFoundError:
+            continue
+        try:
+            os.utime(entry)  # as recently used
+        except FileNotFoundError:
+            pass  # evicted meanwhile by another process
+        os.utime(eps_converted_path(eps))  # newer than the EPS file
+        seeded += 1
+    profiler.note(files=len(eps_files), seeded=seeded)
+    if seeded:
+        print(Color.green('{} of {} EPS conversions are taken from '.format(seeded, len(eps_files)) +
+                          Color.b + eps_cache_path() + Color.g + '.'))
+
+
+@profiler.profiled
+def store_eps_conversions(eps_files):
+    """Save the conversions of ``eps_files`` into the cache, and evict old ones if the cache is full."""
+    stored = 0
+    for eps in eps_files:
+        entry = eps_cache_entry(eps)
+        if is_converted(eps) and not os.path.exists(entry):
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            copy_atomically(eps_converted_path(eps), entry)
+            stored += 1
+    if stored:
+        evict_eps_cache()
+
+
+def evict_eps_cache():
+    """Remove the least recently used conversions while the cache exceeds ``eps_cache_limit`` bytes."""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(eps_cache_path()):
+        for filename in filenames:
+            if not filename.startswith('.'):
+                path = os.path.join(dirpath, filename)
+                try:
+                    s = os.stat(path)
+                except FileNotFoundError:
+                    continue  # evicted by another process, e.g., a child of run_all
+                entries.append((s.st_mtime, s.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= eps_cache_limit:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def gzip_member(data, level=9):
+    """Return ``data`` compressed into a gzip member with a fixed header (no name, zero mtime)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return (b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff' + compressor.compress(data) + compressor.flush() +
+            struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff))
+
+
+class CompressingWriter:
+    """A write-only file object that gzip-compresses the data into ``path``, split into independent gzip
+    members of ``gzip_block_size`` bytes compressed in parallel by ``executor`` (as pigz does).
+    The output depends only on the data and is readable by the standard gzip."""
+    def __init__(self, path, executor, jobs):
+        self.raw = open(path, 'wb')
+        self.executor = executor
+        self.buffer = bytearray()
+        self.pending = []
+        self.max_pending = 2 * jobs  # compressed blocks kept in memory
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(gzip_member, block))
+        while len(self.pending) > self.max_pending:
+            self.raw.write(self.pending.pop(0).result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= gzip_block_size:
+            self.submit(bytes(self.buffer[:gzip_block_size]))
+            del self.buffer[:gzip_block_size]
+
+    def close(self):
+        try:
+            if self.buffer:
+                self.submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.raw.write(self.pending.pop(0).result())
+        finally:
+            self.raw.close()
+
+
+def archive_manifest_path(path):
+    return path + '.manifest.json'
+
+
+def read_archive_manifest(path):
+    """Return the manifest of the archive ``path``, or an empty dict if unavailable."""
+    try:
+        with open(archive_manifest_path(path), 'r') as f:
+            content = json.load(f)
+        return content if isinstance(content, dict) else dict()
+    except (OSError, ValueError):
+        return dict()
+
+
+@functools.lru_cache(maxsize=None)
+def archive_mtime():
+    """Return the mtime of the members of archives, taken from ``SOURCE_DATE_EPOCH`` if valid, or 0."""
+    value = os.environ.get('SOURCE_DATE_EPOCH')
+    if value is None:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        warning('SOURCE_DATE_EPOCH "{}" is not an integer and ignored.'.format(value))
+        return 0
+
+
+def normalize_tarinfo(info):
+    """Remove the status of the local file from ``info`` except the type and the executable bit."""
+    info.mtime = archive_mtime()
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    info.mode = 0o777 if info.issym() else 0o755 if (info.isdir() or info.mode & 0o100) else 0o644
+    return info
+
+
+def archive_entries(basedir, targets):
+    """Return the members of the archive of ``targets`` in ``basedir`` as a list of the names and
+    the normalized ``TarInfo``, in the order in the archive."""
+    helper = tarfile.open(fileobj=io.BytesIO(), mode='w')
+
+    def members(name):
+        yield name
+        full_path = os.path.join(basedir, name)
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            for child in sorted(os.listdir(full_path)):
+                yield from members(os.path.join(name, child))
+
+    entries = []
+    for target in targets:
+        for name in members(target):
+            helper.inodes.clear()  # hard links are archived as files, independent of the layout of inodes
+            info = helper.gettarinfo(os.path.join(basedir, name), arcname=name)
+            if info is not None:
+                entries.append((name, normalize_tarinfo(info)))
+    return entries
+
+
+def describe_member(basedir, name, info):
+    """Return the description of a member in the manifests: the mode and the hash (or the type)."""
+    if info.isreg():
+        return '{:o} {}'.format(info.mode, file_hash(os.path.join(basedir, name)))
+    return '{:o} {}{}'.format(info.mode, info.type.decode(), (' ' + info.linkname) if info.linkname else '')
+
+
+@profiler.profiled
+def write_archives(basedir, targets, archives, previous=None):
+    """Archive ``targets`` in ``basedir`` recursively into ``.tar.gz`` files, reading each file once.
+
+    ``archives`` is a dict from the path of each archive (relative to ``basedir``) to a set of
+    member names excluded from the archive. All the archives are written simultaneously.
+
+    The archives are reproducible: the members are sorted and their owners, mtimes and modes are
+    normalized. The hashes of the members are saved in a manifest next to each archive, and an
+    archive identical to the existing one (or to ``previous[path]``, if given) is not written again.
+    Return the paths of the written archives."""
+    entries = archive_entries(basedir, targets)
+    manifests = dict()
+    for path, excluded in archives.items():
+        manifest = {'format': archive_format, 'mtime': archive_mtime(),
+                    'members': [[name, describe_member(basedir, name, info)] for name, info in entries
+                                if name not in excluded]}
+        existing = (previous or dict()).get(path, os.path.join(basedir, path))
+        old = read_archive_manifest(existing)
+        if os.path.isfile(existing) and old.pop('hash', None) == file_hash(existing) and old == manifest:
+            print(Color.green(Color.b + os.path.relpath(existing) + Color.g +
+                              ' is identical to the last archive and kept.'))
+        else:
+            manifests[path] = manifest
+    if not manifests:
+        return []
+
+    jobs = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        writers = {path: CompressingWriter(os.path.join(basedir, path), executor, jobs) for path in manifests}
+        try:
+            for name, info in entries:
+                outputs = [w for path, w in writers.items() if name not in archives[path]]
+                if not outputs:
+                    continue
+                print(name)
+                header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+                [w.write(header) for w in outputs]
+                if info.isreg():
+                    with open(os.path.join(basedir, name), 'rb') as f:
+                        for chunk in iter(lambda: f.read(1 << 20), b''):
+                            [w.write(chunk) for w in outputs]
+                    if info.size % tarfile.BLOCKSIZE:
+                        [w.write(tarfile.NUL * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)) for w in outputs]
+            for w in writers.values():
+                w.write(tarfile.NUL * (tarfile.RECORDSIZE * 2))  # end-of-archive blocks padded to a record
+        finally:
+            [w.close() for w in writers.values()]
+
+    for path, manifest in manifests.items():
+        full_path = os.path.join(basedir, path)
+        write_json(archive_manifest_path(full_path), dict(manifest, hash=file_hash(full_path)))
+    return list(manifests)
+
+
+warm_start_extensions = ['.aux', '.bbl', '.toc', '.lof', '.lot', '.out', '.nav', '.snm', '.vrb',
+                         '.idx', '.ind', '.ilg', '.glo', '.gls', '.glg', '.ax1', '.ax2', '.brf', '.blg']
+
+
+@profiler.profiled
+def seed_build_state(src_stem, dst_stem, target_dir, src_dir='.'):
+    """Copy the auxiliary files of the last compile of ``src_stem`` in ``src_dir`` to ``target_dir``,
+    renamed for ``dst_stem``, so that the compile in ``target_dir`` starts warm."""
+    seeded = []
+    src = os.path.join(src_dir, src_stem)
+    for ext in warm_start_extensions:
+        if os.path.isfile(src + ext):
+            copy_with_mkdir(src + ext, os.path.join(target_dir, dst_stem + ext))
+            seeded.append(src + ext)
+    # .aux files of \include'd files, which are referred from the main .aux file.
+    if os.path.isfile(src + '.aux'):
+        with open(src + '.aux', 'r', errors='replace') as f:
+            for aux in re.findall(r'\\@input\{([^{}]*)\}', f.read()):
+                if os.path.isfile(os.path.join(src_dir, aux)) and not os.path.isabs(aux):
+                    copy_with_mkdir(os.path.join(src_dir, aux), os.path.join(target_dir, aux))
+                    seeded.append(os.path.join(src_dir, aux))
+    if seeded:
+        print("\n\n" + Color.green('Build state is seeded from ' + Color.b + ', '.join(seeded) + Color.g + '.'))
+    return seeded
+
+
+@profiler.profiled
+def check_clean_room(target_dir, texfile_path, excludes=list(), engine=None):
+    """Check that ``texfile_path`` in ``target_dir`` compiles in a copy of ``target_dir`` excluding ``excludes``,
+    with a single pass in draft mode of the TeX program of ``engine`` (pdflatex for latexmk).
+    Return True if succeeded (or cannot be checked)."""
+    program = pdflatex if engine in [None, 'latexmk'] else engine
+    if not shutil.which(program):
+        warning('{} not found; clean-room check is skipped.'.format(program))
+        return True
+
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    print("\n\n" + Color.green('Check that ' + Color.b + target_dir + Color.g + ' is self-contained.'))
+    tempdir = tempfile.mkdtemp()
+    try:
+        room = os.path.join(tempdir, 'room')
+        shutil.copytree(target_dir, room, copy_function=link_or_copy,
+                        ignore=lambda d, names: [n for n in names if os.path.join(d, n) in
+                                                 [os.path.join(target_dir, e) for e in excludes]])
+        returncode = run_process(
+            [program, '-no-pdf' if program == 'xelatex' else '-draftmode', '-interaction=nonstopmode',
+             '-halt-on-error', texfile_path],
+            cwd=room, stdout=subprocess.DEVNULL).returncode
+    finally:
+        shutil.rmtree(tempdir)
+    return returncode == 0
+
+
+@profiler.profiled
+def archive(config, suffix, style=None, warm=False):
     """Create an archive file ``stem.tar.gz`` etc., where ``stem`` is the
     basename of ``src_tex_path`` without extension with ``suffix``.
 
@@ -393,6 +2267,12 @@ def archive(config, suffix, style=None):
       * ``bar_v1.pdf``
       * ``bar_v1.tar.gz``
       * ``bar_v1.withpdf.tar.gz``
+
+    If ``warm``, the compile in ``stem`` directory starts from the auxiliary files of the last
+    compile in the current directory, and the result is verified by ``check_clean_room``.
+
+    If the archives with ``suffix`` exist with their manifests, and the outputs are unmodified since
+    then, they are built again in a staging directory and replace the old ones.
     """
 
     check_latexmk()
@@ -409,96 +2289,143 @@ def archive(config, suffix, style=None):
         names['archive'] = dst_tex_stem + '.tar.gz'
         names['arcwpdf'] = dst_tex_stem + '.withpdf.tar.gz'
 
-    def dst_path(tag_name): return os.path.join(names['tempdir'], names[tag_name])
-
-    # files created in the current directory
-    for tag in ['tempdir', 'pdffile', 'archive', 'arcwpdf']:
+    pdf_member = names['pdffile'] if style == 'JHEP' else os.path.join(names['tempdir'], names['pdffile'])
+
+    def layout(workdir):
+        """Return the base directory and the targets of the archives of ``workdir``."""
+        if style == 'JHEP':
+            return workdir, sorted(os.listdir(workdir))
+        return os.path.dirname(workdir) or '.', [names['tempdir']]
+
+    recorded = {tag: read_archive_manifest(names[tag]) for tag in ['archive', 'arcwpdf']}
+
+    def unchanged_since_archived():
+        """Return True if the outputs in the current directory are as recorded in the manifests read above."""
+        if os.path.lexists(names['tempdir']):
+            if not os.path.isdir(names['tempdir']) or os.path.islink(names['tempdir']):
+                return False
+            basedir, targets = layout(names['tempdir'])
+            members = [[name, describe_member(basedir, name, info)]
+                       for name, info in archive_entries(basedir, targets)]
+            if members != recorded['archive'].get('members'):
+                return False
+        if os.path.lexists(names['pdffile']):
+            members = dict(map(tuple, recorded['arcwpdf'].get('members', [])))
+            if not os.path.isfile(names['pdffile']) or \
+                    members.get(pdf_member, '').split(' ')[-1] != file_hash(names['pdffile']):
+                return False
+        return True
+
+    # outputs of a previous archive with the same suffix, identified by the manifests of the archives, are
+    # replaced by the ones built in a staging directory only if unmodified since then; the archives are
+    # kept if identical. Otherwise, the outputs must be absent.
+    previous = all(recorded.values())
+    if previous and not unchanged_since_archived():
+        error('{} is modified since it was archived; remove it (or use another suffix) to archive again.'.format(
+            names['tempdir']))
+    for tag in ([] if previous else ['tempdir', 'pdffile', 'archive', 'arcwpdf']):
         check_absence(names[tag])
+    staging = tempfile.mkdtemp(prefix='archive-', dir=os.path.abspath(cache_dir)) if previous else None
+    workdir = os.path.join(staging, names['tempdir']) if staging else names['tempdir']
+    keep_staging = False
 
-    deps = get_and_collect_dependencies(src_tex_path, names['tempdir'], names['texfile'])
-
-    with cd(names['tempdir']):
-        compile_tex({'texfile': names['texfile']}, remove_misc=True, quiet=True)
-        [remove_file(f.replace('.eps', '-eps-converted-to.pdf')) for f in deps if f.endswith('.eps')]
-
-    if style == 'JHEP':
-        basedir = names['tempdir']
-        names['arcwpdf'] = os.path.join('..', names['arcwpdf'])
-        names['archive'] = os.path.join('..', names['archive'])
-        targets = os.listdir(names['tempdir'])
-    else:
-        basedir = '.'
-        targets = [names['tempdir']]
-
-    print("\n\n" + Color.green('Compressing into ' + Color.b + names['arcwpdf'] + Color.g + ' with PDF.'))
-    subprocess.Popen(['tar', 'czvf', names['arcwpdf']] + targets, cwd=basedir).communicate()
-
-    shutil.move(dst_path('pdffile'), '.')
-
-    print("\n\n" + Color.green('Compressing into ' + Color.b + names['archive'] + Color.g + ' without PDF.'))
-    subprocess.Popen(['tar', 'czvf', names['archive']] + targets, cwd=basedir).communicate()
+    try:
+        if warm:
+            seed_build_state(get_tex_stem(src_tex_path), dst_tex_stem, workdir, build_dir_of(config) or '.')
+        deps = get_and_collect_dependencies(src_tex_path, workdir, names['texfile'])
+
+        with cd(workdir):
+            compile_tex({'texfile': names['texfile'], 'engine': config.get('engine')}, remove_misc=True, quiet=True)
+            [remove_file(f.replace('.eps', '-eps-converted-to.pdf')) for f in deps if f.endswith('.eps')]
+
+        basedir, targets = layout(workdir)
+        # with staging, the archives are also written there, and replace the old ones with the outputs.
+        outputs = {tag: os.path.join(staging, names[tag]) if staging else names[tag] for tag in ['archive', 'arcwpdf']}
+        archives = {tag: os.path.relpath(outputs[tag], basedir) for tag in ['archive', 'arcwpdf']}
+
+        # the clean-room check runs while the archives are written, which are removed if the check fails.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            checked = executor.submit(check_clean_room, workdir, names['texfile'], [names['pdffile']],
+                                      engine=config.get('engine')) if warm else None
+            print("\n\n" + Color.green('Compressing into ' + Color.b + names['arcwpdf'] + Color.g + ' with PDF and ' +
+                                       Color.b + names['archive'] + Color.g + ' without PDF.'))
+            written = write_archives(basedir, targets, {archives['arcwpdf']: set(), archives['archive']: {pdf_member}},
+                                     previous={archives[tag]: names[tag] for tag in archives} if staging else None)
+            if checked and not checked.result():
+                [remove_file(f(outputs[tag])) for tag in ['archive', 'arcwpdf']
+                 for f in [lambda x: x, archive_manifest_path]]
+                error('{} does not compile by itself; the archive is not created.'.format(names['tempdir']))
+
+        if staging:
+            if not unchanged_since_archived():
+                keep_staging = True
+                error('{} is modified during the archive; the new one is left in {}.'.format(
+                    names['tempdir'], staging))
+            if os.path.isdir(names['tempdir']):
+                shutil.rmtree(names['tempdir'])
+            remove_file(names['pdffile'])
+            os.replace(workdir, names['tempdir'])
+            for tag in [tag for tag in ['archive', 'arcwpdf'] if archives[tag] in written]:
+                os.replace(outputs[tag], names[tag])
+                os.replace(archive_manifest_path(outputs[tag]), archive_manifest_path(names[tag]))
+    finally:
+        if staging and not keep_staging:
+            shutil.rmtree(staging, ignore_errors=True)
+    shutil.move(os.path.join(names['tempdir'], names['pdffile']), '.')
+
+    if config.get('store'):
+        store = stores_of(config)['local']
+        with store.lock():
+            store.ingest(dst_tex_stem, names['tempdir'], texfile=src_tex_path, suffix=suffix, style=style)
+        print("\n" + Color.green('Version ' + Color.b + dst_tex_stem + Color.g + ' is saved in ' + Color.b +
+                                 store.path + Color.g + '.'))
 
     if style == 'JHEP':
         print("\n" + Color.green('The archives are without top directory, ready for JHEP-submission.'))
 
 
+@profiler.profiled
 def push(config, suffix=None):
-    """Update the files in ``remotedir_path`` with the local version.
-    ``.tex``, ``.bbl``, and ``.pdf`` files are updated as well as requisites."""
+    """Update the files in the remote directories with the local version.
+    ``.tex``, ``.bbl``, and ``.pdf`` files are updated as well as requisites.
 
-    texfile_path = config.get('texfile')
-    remotedir_path = config['remotedir']
+    If ``remotedir`` is a list, the compile and the dependency check are done once, and the files
+    are copied to all the directories concurrently after a single confirmation."""
 
-    def remote_path(src_name): return os.path.join(remotedir_path, src_name)
-
-    file_list = []
+    texfile_path = config.get('texfile')
+    remotedirs = remotedirs_of(config)
 
+    artifacts = []  # (key, src, name in remotedir)
     dependencies = []
+    tex_dependencies = []
     if texfile_path:
         compile_tex(config, quiet=True)
         stem = get_tex_stem(texfile_path)
 
-        files = {  # key = src, dst
-            'tex': {'src': texfile_path,
-                    'dst': remote_path(os.path.join(os.path.dirname(texfile_path), stem + (suffix or '') + '.tex'))},
-            'pdf': {'src': stem + '.pdf', 'dst': remote_path(stem + (suffix or '') + '.pdf')},
-            'bbl': {'src': stem + '.bbl', 'dst': remote_path(stem + (suffix or '') + '.bbl')},
-        }
-
-        def remote_path(src_name):
-            for ext in [".ax2"]:
-                if src_name == stem + ext:
-                    src_name = stem + (suffix or '') + ext
-            return os.path.join(remotedir_path, src_name)
-
-        if not os.path.isfile(files['bbl']['src']):
-            del files['bbl']
-        for k, v in files.items():
-            if os.path.isfile(v['src']):
-                files[k]['mode'] = compare_files_and_get_mode(v['src'], v['dst'])
-            else:
-                error('{} not found.'.format(v['src']))
-
-        existing_files = [k for k, v in files.items() if v['mode'] == 'conflict' or v['mode'] == 'update']
-        if existing_files and files['tex']['mode'] == 'ignore':
-            [print('  ' + Color.mode_tag(v['mode']) + ' ' + v['src']) for k, v in files.items()]
-            if input("\nIgnore the differences in PDF / bbl? (Y/n) ").lower() != 'n':
-                for k in existing_files:
-                    files[k]['mode'] = 'ignore'
-            elif input(Color.yellow("\nForce update these files? (y/N) ")).lower() == 'y':
-                for k in existing_files:
-                    files[k]['mode'] = 'update'
-            else:
-                error('Abort.')
-
-        for v in files.values():
-            file_list.append((v['mode'], v['src'], v['dst']))
-
-        dependencies = get_dependencies(texfile_path)
+        artifacts = [
+            ('tex', texfile_path, os.path.join(os.path.dirname(texfile_path), stem + (suffix or '') + '.tex')),
+            ('pdf', stem + '.pdf', stem + (suffix or '') + '.pdf'),
+            ('bbl', stem + '.bbl', stem + (suffix or '') + '.bbl'),
+        ]
+        if not os.path.isfile(stem + '.bbl'):
+            artifacts.pop()
+        for k, src, name in artifacts:
+            if not os.path.isfile(src):
+                error('{} not found.'.format(src))
+
+        # the record of the compile above is used if available, where -deps check is the fallback.
+        dependencies = get_recorded_dependencies(texfile_path, build_dir_of(config))
+        if dependencies is None:
+            dependencies = get_dependencies(texfile_path)
+        else:
+            print("\n\n" + Color.green('Dependency of ' + Color.b + texfile_path + Color.g +
+                                       ' is taken from the recorder.'))
+        update_index(texfile_path, dependencies)
         for src in dependencies:
             if os.path.isabs(src):
                 # NOTE: should be warning? MISHO cannot imagine the case falling here.
                 error('This TeX depends on {}, which cannot be pushed.'.format(src))
+        tex_dependencies = list(dependencies)
 
     for src in config.get('extra', []):
         if not os.path.exists(src):
@@ -506,50 +2433,244 @@ def push(config, suffix=None):
         else:
             dependencies.append(src)
 
-    for src in dependencies:
-        dst = remote_path(src)
-        mode = compare_files_and_get_mode(src, dst)
-        file_list.append((mode, src, dst))
+    def remote_name(src_name):
+        for ext in [".ax2"]:
+            if texfile_path and src_name == stem + ext:
+                src_name = stem + (suffix or '') + ext
+        return src_name
+
+    manifests = dict()
+    artifact_files = dict()  # remotedir => {key: {'src', 'dst', 'mode'}}
+    for remotedir_path in remotedirs:
+        manifest = manifests[remotedir_path] = SyncManifest(remotedir_path)
+        manifest.index.prefetch([os.path.join(remotedir_path, name) for k, src, name in artifacts] +
+                                [os.path.join(remotedir_path, remote_name(src)) for src in dependencies])
+        files = artifact_files[remotedir_path] = {k: {'src': src, 'dst': os.path.join(remotedir_path, name)}
+                                                  for k, src, name in artifacts}
+        for k, v in files.items():
+            files[k]['mode'] = compare_files_and_get_mode(v['src'], v['dst'], manifest)
+
+    # the differences only in PDF / bbl are confirmed once for all the remote directories.
+    existing_files = [v for files in artifact_files.values() if files['tex']['mode'] == 'ignore'
+                      for v in files.values() if v['mode'] == 'conflict' or v['mode'] == 'update']
+    if existing_files:
+        [print('  ' + Color.mode_tag(v['mode']) + ' ' + v['dst']) for files in artifact_files.values()
+         if files['tex']['mode'] == 'ignore' for v in files.values()]
+        if plan_file:  # planning never prompts; the default answer is recorded, as with --yes.
+            print(Color.yellow("\nThe differences in PDF / bbl are ignored in the plan."))
+        if plan_file or ask("\nIgnore the differences in PDF / bbl? (Y/n) ", default=True):
+            for v in existing_files:
+                v['mode'] = 'ignore'
+        elif ask(Color.yellow("\nForce update these files? (y/N) ")):
+            for v in existing_files:
+                v['mode'] = 'update'
+        else:
+            error('Abort.')
 
-    push_and_pull_execute(file_list)
-    return
+    file_list = []
+    for remotedir_path in remotedirs:
+        for v in artifact_files[remotedir_path].values():
+            file_list.append((v['mode'], v['src'], v['dst']))
+        for src in dependencies:
+            dst = os.path.join(remotedir_path, remote_name(src))
+            file_list.append((compare_files_and_get_mode(src, dst, manifests[remotedir_path]), src, dst))
 
+    push_files(config, suffix, file_list, manifests, tex_dependencies)
+
+
+def push_files(config, suffix, file_list, manifests, tex_dependencies):
+    """Execute the operations in ``file_list`` computed by ``push`` (or loaded by ``apply``), where
+    ``manifests`` is a dict of ``SyncManifest`` for each remote directory, and write the dependency
+    manifests of the pushed TeX file. With ``store``, the files are installed through the object stores."""
+    texfile_path = config.get('texfile')
+    remotedirs = list(manifests)
+    plan_context = {'command': 'push', 'target': texfile_path or config.get('name'), 'suffix': suffix,
+                    'dependencies': tex_dependencies}
+
+    def remote_tex(remotedir_path):
+        return os.path.join(remotedir_path, os.path.dirname(texfile_path),
+                            get_tex_stem(texfile_path, check_exists=False) + (suffix or '') + '.tex')
+
+    if not config.get('store'):
+        if push_and_pull_execute(file_list, list(manifests.values()), copy_function=copy_function_of(config),
+                                 plan_context=plan_context):
+            for remotedir_path, manifest in manifests.items():
+                if texfile_path:
+                    write_dependency_manifest(remote_tex(remotedir_path), texfile_path, tex_dependencies, manifest)
+        return
+
+    # with "store", the files are materialized from the objects, and the push is saved as a version.
+    stores = {d: ObjectStore(os.path.join(d, store_dir)) for d in remotedirs}
+
+    def install(src, dst):
+        return stores[next(d for d in remotedirs if dst.startswith(os.path.join(d, '')))].install(src, dst)
+
+    with contextlib.ExitStack() as stack:
+        [stack.enter_context(store.lock()) for store in stores.values()]
+        if not push_and_pull_execute(file_list, list(manifests.values()), copy_function=install,
+                                     plan_context=plan_context):
+            return
+        name = get_tex_stem(texfile_path, check_exists=False) + (suffix or '') if texfile_path else config.get('name')
+        for remotedir_path, store in stores.items():
+            entries = [(mode, dst) for mode, src, dst in file_list if dst.startswith(os.path.join(remotedir_path, ''))]
+            for mode, dst in entries:
+                if mode == 'ignore':
+                    digest = store.put(dst)  # stored without rewriting the file in the shared folder,
+                    if os.stat(dst).st_nlink > 1 and os.path.samefile(dst, store.object_path(digest)):
+                        store.materialize(digest, dst)  # unless hard-linked to the object by older versions
+                        manifests[remotedir_path].index.invalidate(dst)
+            store.write_tree(name, {os.path.relpath(dst, remotedir_path): manifests[remotedir_path].hash(dst)
+                                    for _, dst in entries}, texfile=texfile_path, suffix=suffix)
+            print(Color.green('Version ' + Color.b + name + Color.g + ' is saved in ' +
+                              Color.b + store.path + Color.g + '.'))
+    if texfile_path:
+        for remotedir_path, manifest in manifests.items():
+            write_dependency_manifest(remote_tex(remotedir_path), texfile_path, tex_dependencies, manifest)
 
-def push_and_pull_execute(file_list):
-    print("\nOperation:")
-    [print('  ' + Color.mode_tag(tag) + ' ' + dst) for tag, src, dst in file_list]
 
-    if [x for x in file_list if x[0] == 'conflict']:
+def dependency_manifest_path(remote_tex):
+    return remote_tex[0:-4] + '.runtex-deps.json'
+
+
+def write_dependency_manifest(remote_tex, texfile_path, dependencies, manifest):
+    """Write the list of ``dependencies`` of ``texfile_path`` with their hashes next to ``remote_tex``,
+    so that ``pull`` finds the files to fetch without TeX runs."""
+    content = {
+        'texfile': os.path.basename(remote_tex),
+        'texfile_hash': manifest.hash(texfile_path),
+        'files': {f: manifest.hash(f) for f in dependencies},
+    }
+    write_json(dependency_manifest_path(remote_tex), content)
+    manifest.save()
+
+
+def read_dependency_manifest(remote_tex, manifest):
+    """Return the dependencies of ``remote_tex`` written by ``push``, or None if the list is unavailable
+    or ``remote_tex`` or the listed sources, which may add dependencies, are modified since then."""
+    try:
+        with open(dependency_manifest_path(remote_tex), 'r') as f:
+            content = json.load(f)
+        if content['texfile_hash'] != manifest.hash(remote_tex):
+            return None
+        for f, digest in content['files'].items():
+            if os.path.splitext(f)[1] in ['.tex', '.sty', '.cls', '.bib'] and \
+                    digest != manifest.hash(os.path.join(manifest.remotedir, f)):
+                return None
+        return sorted(content['files'], key=lambda x: os.path.splitext(x)[::-1])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def manifest_for(manifests, src, dst):
+    """Return the one of ``manifests`` whose remote directory contains ``src`` or ``dst``."""
+    for m in manifests:
+        if m.locate(dst)[0] == 'remote' or m.locate(src)[0] == 'remote':
+            return m
+
+
+def write_plan(path, file_list, manifests, context):
+    """Write the operations in ``file_list`` with the sizes and hashes of the files to ``path``,
+    together with ``context`` (command, target, etc.) needed by ``apply``."""
+    def describe(file_path, manifest):
+        if not os.path.lexists(file_path):
+            return None, None
+        return os.stat(file_path).st_size, (manifest.hash(file_path) if manifest else file_hash(file_path))
+
+    files = []
+    for mode, src, dst in file_list:
+        manifest = manifest_for(manifests, src, dst)
+        (size, src_hash), (_, dst_hash) = describe(src, manifest), describe(dst, manifest)
+        files.append({'mode': mode, 'src': src, 'dst': dst, 'size': size, 'src_hash': src_hash, 'dst_hash': dst_hash})
+    content = dict(context, version=plan_version, created=time.strftime('%Y-%m-%dT%H:%M:%S'), cwd=os.getcwd(),
+                   remotedirs=[m.remotedir for m in manifests], files=files)
+    write_json(path, content)
+    [m.save() for m in manifests]
+
+
+@profiler.profiled
+def push_and_pull_execute(file_list, manifest=None, copy_function=copy_atomically, plan_context=None):
+    """Show and execute the operations in ``file_list`` after confirmation, copying by ``copy_function``.
+    ``manifest`` may be a list of ``SyncManifest`` for multiple remote directories, for which the
+    operations are listed and the conflicts are reported for each directory.
+    If ``plan_file`` is set, the operations are written to it with ``plan_context`` instead of executed.
+    Return True if the destinations are up to date afterward."""
+    manifests = manifest if isinstance(manifest, list) else [m for m in [manifest] if m is not None]
+
+    def manifest_of(src, dst): return manifest_for(manifests, src, dst)
+
+    print("\nOperation:")
+    if len(manifests) > 1:
+        for m in manifests:
+            print('  ' + Color.b + m.remotedir + Color.end)
+            [print('    ' + Color.mode_tag(tag) + ' ' + dst) for tag, src, dst in file_list
+             if manifest_of(src, dst) is m]
+    else:
+        [print('  ' + Color.mode_tag(tag) + ' ' + dst) for tag, src, dst in file_list]
+
+    [m.save() for m in manifests]
+    conflicts = [x for x in file_list if x[0] == 'conflict']
+    if conflicts:
+        if len(manifests) > 1:
+            for m in manifests:
+                count = len([x for x in conflicts if manifest_of(x[1], x[2]) is m])
+                print(('  ' + Color.red('{} conflict(s)') + ' in {}').format(count, m.remotedir) if count else
+                      '  no conflict in {}'.format(m.remotedir))
         error('Conflict detected. Abort for safety.')
 
     execute = [x for x in file_list if x[0] != 'ignore']
-    if execute and input("\nCONTINUE? (y/N) ").lower() == 'y':
+    if plan_file:
+        write_plan(plan_file, file_list, manifests, plan_context or dict())
+        print("\n" + Color.green('{} operation(s) are planned in '.format(len(execute)) + Color.b + plan_file +
+                                 Color.g + '; run "apply" to execute them.'))
+        return False
+    if execute and ask("\nCONTINUE? (y/N) "):
         src_len = max([len(src) for tag, src, dst in execute])
-        fmt = '{color}{src:<' + str(src_len) + '} => {dst}{e}'
-        for tag, src, dst in file_list:
-            if tag != 'ignore':
-                copy_with_mkdir(src, dst)
+        fmt = '{color}{src:<' + str(src_len) + '} => {dst}{e}  ({size}, {rate}/s)'
+        modes = {dst: tag for tag, src, dst in execute}
+        total, begin = 0, time.time()
+        try:
+            for src, dst, size, seconds in transfer_files([(src, dst) for tag, src, dst in execute],
+                                                          copy_function=copy_function):
+                total += size
+                if manifests:
+                    manifest_of(src, dst).record(src, dst)
                 print(fmt.format(
                     src=src,
                     dst=dst,
-                    color=Color.y if tag == 'update' else '',
+                    size=human_size(size),
+                    rate=human_size(size / max(seconds, 1e-6)),
+                    color=Color.y if modes[dst] == 'update' else '',
                     e=Color.end))
-    return
-
-
+        finally:
+            [m.save() for m in manifests]
+        elapsed = time.time() - begin
+        saved = getattr(copy_function, 'saved', 0)
+        profiler.note(files=len(execute), bytes=total, saved=saved)
+        print('\n{} files, {} in {:.2f} s ({}/s)'.format(
+            len(execute), human_size(total), elapsed, human_size(total / max(elapsed, 1e-6))) +
+            (', {} saved by delta transfer'.format(human_size(saved)) if saved else ''))
+        return True
+    return not execute
+
+
+@profiler.profiled
 def pull(config, suffix=None):
-    """Update the local files with the version in ``remotedir_path`` without compile.
+    """Update the local files with the version in ``remotedir_path`` (the first one if multiple) without compile.
     Note that ``texfile_path`` is a path to the local version.
     ``.tex`` file is updated with suffix resolved.
     ``.bbl`` and ``.pdf`` files are kept.
     Requisites are updated."""
 
     texfile_path = config.get('texfile')
-    remotedir_path = config['remotedir']
+    remotedir_path = remotedirs_of(config)[0]
+    if len(remotedirs_of(config)) > 1:
+        print(Color.green('Pull from ' + Color.b + remotedir_path + Color.g +
+                          ', the first of the remote directories.'))
 
     def remote_path(src_name): return os.path.join(remotedir_path, src_name)
 
     file_list = []
+    manifest = SyncManifest(remotedir_path)
 
     dependencies = []
     if texfile_path:
@@ -563,23 +2684,30 @@ def pull(config, suffix=None):
                     src_name = get_tex_stem(remote_tex) + ext
             return os.path.join(remotedir_path, src_name)
 
-        if not os.path.isfile(remote_tex):
-            d = os.path.dirname(remote_tex)
-            candidates = "\t".join([f for f in os.listdir(d)
-                                    if os.path.isfile(os.path.join(d, f))
-                                    and f.startswith(stem) and f.endswith('.tex')])
+        if not manifest.index.isfile(remote_tex):
+            # the TeX files starting with the stem, then the ones with similar names (e.g., typos in suffix).
+            names = [f for f in manifest.index.files(os.path.dirname(remote_tex)) if f.endswith('.tex')]
+            candidates = [f for f in names if f.startswith(stem)]
+            candidates += [f for f in difflib.get_close_matches(os.path.basename(remote_tex), names, n=10, cutoff=0.6)
+                           if f not in candidates]
+            candidates = "\t".join(candidates)
             error('{tex} not found.\n\nCandidates are:\n{candidates}'.format(
                 tex=remote_tex,
                 candidates=candidates,
             ))
 
-        mode = compare_files_and_get_mode(remote_tex, texfile_path)
+        mode = compare_files_and_get_mode(remote_tex, texfile_path, manifest)
         file_list.append((mode, remote_tex, texfile_path))
 
-        tempdir = tempfile.mkdtemp()
-        with cd(remotedir_path):
-            dependencies = get_and_collect_dependencies(texfile_path_remote, tempdir, texfile_path)
-        shutil.rmtree(tempdir)
+        dependencies = read_dependency_manifest(remote_tex, manifest)
+        if dependencies is not None:
+            print("\n\n" + Color.green('Dependency of ' + Color.b + remote_tex + Color.g +
+                                       ' is taken from the manifest.'))
+        else:
+            tempdir = tempfile.mkdtemp()
+            with cd(remotedir_path):
+                dependencies = get_and_collect_dependencies(texfile_path_remote, tempdir, texfile_path)
+            shutil.rmtree(tempdir)
         for dst in dependencies:
             if os.path.isabs(dst):
                 warning('This TeX depends on {}, which is not pulled and ignored.'.format(dst))
@@ -590,40 +2718,528 @@ def pull(config, suffix=None):
             warning('extra file {} not found and ignored.'.format(remote_path(dst)))
         dependencies.append(dst)
 
+    manifest.index.prefetch([remote_path(dst) for dst in dependencies])
     for dst in dependencies:
         src = remote_path(dst)
-        mode = compare_files_and_get_mode(src, dst)
+        mode = compare_files_and_get_mode(src, dst, manifest)
         file_list.append((mode, src, dst))
 
-    push_and_pull_execute(file_list)
+    push_and_pull_execute(file_list, manifest, copy_function=copy_function_of(config),
+                          plan_context={'command': 'pull', 'target': texfile_path or config.get('name'),
+                                        'suffix': suffix})
     return
 
 
-if __name__ == '__main__':
+def apply(config_list, path):
+    """Execute the operations planned by ``push --plan`` or ``pull --plan`` in ``path`` without compile or
+    dependency check, after checking that no file is modified since the plan. The plan is the confirmation."""
+    global assume_yes
+    try:
+        with open(path, 'r') as f:
+            plan = json.load(f)
+        if plan.get('version') != plan_version or plan.get('command') not in ['push', 'pull']:
+            error('{} is not a plan of this version of runtex.'.format(path))
+    except (OSError, ValueError, AttributeError) as e:
+        error('{} cannot be read: {}'.format(path, e))
+    if os.path.realpath(plan['cwd']) != os.path.realpath(os.getcwd()):
+        error('the plan is for {}; run "apply" there.'.format(plan['cwd']))
+    config = config_list.get(plan['target'])
+    if config is None:
+        error('target {} of the plan is not in configuration.'.format(plan['target']))
+
+    manifests = {d: SyncManifest(d) for d in plan['remotedirs']}
+    drifted = []
+    for entry in plan['files']:
+        manifest = manifest_for(list(manifests.values()), entry['src'], entry['dst'])
+        for key in ['src', 'dst']:
+            exists = os.path.lexists(entry[key])
+            recorded = entry[key + '_hash']
+            if exists != (recorded is not None) or (exists and manifest.hash(entry[key]) != recorded):
+                drifted.append(entry[key])
+    if drifted:
+        [print('  ' + Color.red('[drifted]') + ' ' + f) for f in drifted]
+        error('{} file(s) are modified since the plan was made. Abort for safety.'.format(len(drifted)))
+
+    file_list = [(entry['mode'], entry['src'], entry['dst']) for entry in plan['files']]
+    assume_yes = True
+    if plan['command'] == 'push':
+        push_files(config, plan['suffix'], file_list, manifests, plan['dependencies'])
+    else:
+        push_and_pull_execute(file_list, list(manifests.values()), copy_function=copy_function_of(config))
+
+
+def versions(config):
+    """List the versions of the target saved in the object stores."""
+    for side, store in stores_of(config).items():
+        trees = [t for t in store.trees() if t.get('texfile') == config.get('texfile') or
+                 (not config.get('texfile') and t.get('name') == config.get('name'))]
+        if not trees:
+            continue
+        print(Color.green('Versions in ' + Color.b + store.path + Color.g + ' ({}):'.format(
+            'local' if side == 'local' else 'remote')))
+        for tree in trees:
+            size = sum(store.size(d) for d in tree['files'].values())
+            print('  {:<32} {}  {:>5} files  {:>10}'.format(tree['name'], tree.get('created', ''),
+                                                            len(tree['files']), human_size(size)))
+
+
+def checkout(config, suffix):
+    """Materialize the version with ``suffix`` into a directory in the current directory,
+    taken from the local store (i.e., archives) if available, and otherwise from the remote one."""
+    name = (get_tex_stem(config['texfile'], check_exists=False) if config.get('texfile') else config['name']) + suffix
+    check_absence(name)
+    for side, store in stores_of(config).items():
+        if store.read_tree(name) is not None:
+            tree = store.checkout(name, name)
+            print(Color.green('Version ' + Color.b + name + Color.g + ' ({} files) is checked out from '.format(
+                len(tree['files'])) + Color.b + store.path + Color.g + '.'))
+            return
+    error('version {} not found; see "versions".'.format(name))
+
+
+def collect_garbage(config):
+    """Remove the objects no longer referred from any version."""
+    for side, store in stores_of(config).items():
+        if os.path.isdir(store.path):
+            removed, freed = store.gc()
+            print(Color.green('{} objects ({}) are removed from '.format(removed, human_size(freed)) +
+                              Color.b + store.path + Color.g + '.'))
+
+
+class PollingWatcher:
+    """Watch files by polling their status every ``interval`` seconds."""
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.paths = dict()
+
+    @staticmethod
+    def signature(path):
+        try:
+            s = os.stat(path)
+            return (s.st_mtime_ns, s.st_size, s.st_ino)
+        except OSError:
+            return None
+
+    def watch(self, paths):
+        self.paths = {p: self.signature(p) for p in paths}
+
+    def wait(self, timeout=None):
+        """Return a set of modified paths, waiting for a modification at most ``timeout`` seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = set()
+            for path, signature in self.paths.items():
+                new_signature = self.signature(path)
+                if new_signature != signature:
+                    self.paths[path] = new_signature
+                    changed.add(path)
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.time())))
+
+
+class InotifyWatcher:
+    """Watch files through inotify, watching their parent directories so that files replaced by editors
+    are also detected. Use ``create`` to construct, which returns None if inotify is unavailable."""
+    mask = 0x00000002 | 0x00000004 | 0x00000008 | 0x00000040 | 0x00000080 | 0x00000100 | 0x00000200
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, libc, fd):
+        self.libc = libc
+        self.fd = fd
+        self.dirs = dict()  # wd => dir
+        self.paths = set()
+
+    @classmethod
+    def create(cls):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return None
+        return cls(libc, fd) if fd >= 0 else None
+
+    def watch(self, paths):
+        self.paths = set(os.path.normpath(p) for p in paths)
+        watched = set(self.dirs.values())
+        for d in set(os.path.dirname(p) or '.' for p in self.paths) - watched:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), self.mask)
+            if wd >= 0:
+                self.dirs[wd] = d
+
+    def wait(self, timeout=None):
+        """Return a set of modified paths, waiting for a modification at most ``timeout`` seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        changed = set()
+        while not changed:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                break
+            if not select.select([self.fd], [], [], remaining)[0]:
+                break
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(data):
+                wd, _, _, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                offset += 16 + length
+                if wd in self.dirs and name:
+                    path = os.path.normpath(os.path.join(self.dirs[wd], os.fsdecode(name)))
+                    if path in self.paths:
+                        changed.add(path)
+        return changed
+
+
+def watch(config, debounce=0.3):
+    """Compile ``config['texfile']`` whenever it, its dependencies, or ``config_file`` is modified."""
+    texfile_path = config['texfile']
+    watcher = InotifyWatcher.create()
+    if watcher is None:
+        warning('inotify is not available; files are polled instead.')
+        watcher = PollingWatcher()
+
+    dependencies = get_dependencies(texfile_path)
+    try:
+        while True:
+            paths = [texfile_path, config_file] + [f for f in dependencies if not os.path.isabs(f)]
+            watcher.watch(paths)
+            print("\n" + Color.green('Watching ' + Color.b + texfile_path + Color.g +
+                                     ' and {} files. (Ctrl-C to stop)'.format(len(paths) - 1)))
+            changed = watcher.wait()
+            while True:
+                # further modifications within ``debounce`` seconds are merged into this build.
+                more = watcher.wait(debounce)
+                if not more:
+                    break
+                changed |= more
+            [print('  ' + Color.yellow('[modified]') + ' ' + f) for f in sorted(changed)]
+
+            if config_file in changed:
+                config = read_config().get(texfile_path)
+                if config is None:
+                    error('{} is removed from {}.'.format(texfile_path, config_file))
+            if not os.path.exists(texfile_path):
+                warning('{} not found; waiting for it to appear.'.format(texfile_path))
+                continue
+            if not compile_tex(config, quiet=True, abort=False):
+                continue  # keep watching the same files until the error is fixed.
+            # refresh the watched files, as \input's may be added or removed.
+            dependencies = get_recorded_dependencies(texfile_path, build_dir_of(config))
+            if dependencies is None:
+                dependencies = get_dependencies(texfile_path)
+            update_index(texfile_path, dependencies)
+    except KeyboardInterrupt:
+        print("\n" + Color.green('Stop watching.'))
+
+
+def run_all(command, targets, args, jobs, warm_start=False):
+    """Run ``command`` for each of ``targets`` in child processes, ``jobs`` at once.
+
+    Output of each child is prefixed with its target, and a summary is shown at the end.
+    Return True if all the targets succeeded."""
+    lock = threading.Lock()
+    width = max(len(t) for t in targets)
+    flags = (['--no-cache'] if not use_cache else []) + (['--yes'] if assume_yes else []) + \
+        (['--warm'] if warm_start else [])
+
+    def run(target):
+        prefix = Color.sky('[' + target.ljust(width) + ']') + ' '
+        begin = time.time()
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(sys.argv[0]), command, target] + args + flags,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        for line in process.stdout:
+            with lock:
+                print(prefix + line.decode('utf-8', errors='replace').rstrip('\n'), flush=True)
+        returncode = process.wait()
+        profiler.add('run_all ' + target, wall=time.time() - begin)
+        return returncode, time.time() - begin
+
+    print(Color.green('Run "{}" for {} targets with {} jobs.'.format(command, len(targets), jobs)))
+    begin = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        results = dict(zip(targets, executor.map(run, targets)))
+
+    print("\n\n" + Color.green('Summary:'))
+    for target, (returncode, elapsed) in results.items():
+        tag = Color.green('[ok]    ') if returncode == 0 else Color.red('[failed]')
+        note = '' if returncode == 0 else ' (exit {})'.format(returncode)
+        print('  {} {}  {:8.1f} s{}'.format(tag, target.ljust(width), elapsed, note))
+    print('  total {:.1f} s'.format(time.time() - begin))
+    return all(returncode == 0 for returncode, _ in results.values())
+
+
+def daemon_target(argv, configs):
+    """Return the target of the command line ``argv`` (without the program name), by which
+    requests to ``daemon`` are serialized."""
+    args = [a for a in argv if not a.startswith('-')]
+    if len(args) > 1 and (args[1] in configs or args[1] == 'all'):
+        return args[1]
+    return list(configs.keys())[0] if len(configs) == 1 else ''
+
+
+def daemon_warm_up():
+    """Load the configurations and hash the files in the dependency cache, so that the processes
+    forked by ``daemon`` start with them in memory."""
+    read_config()
+    for entry in load_cache('dependencies.json').values():
+        for path in entry.get('hashes', {}):
+            try:
+                file_hash(path)
+            except OSError:
+                pass
+
+
+def daemon_handle(connection, target_locks, lock):
+    """Serve a request of ``daemon_client`` on ``connection`` by a forked process."""
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(1)  # byte by byte, not to consume the stdin forwarded after the request.
+        if not chunk:
+            connection.close()
+            return
+        data += chunk
+    request = json.loads(data.decode('utf-8'))
+    if request.get('stop'):
+        connection.sendall(b'\0runtex-exit:0\n')
+        connection.close()
+        os.kill(os.getpid(), signal.SIGTERM)
+        return
+    if os.path.realpath(request['cwd']) != os.path.realpath(os.getcwd()):
+        connection.sendall(Color.red('[ERROR] the daemon serves {}.\n'.format(os.getcwd())).encode() +
+                           b'\0runtex-exit:1\n')
+        connection.close()
+        return
+
+    with lock:
+        configs = read_config()
+        target_lock = target_locks.setdefault(daemon_target(request['argv'], configs), threading.Lock())
+    with target_lock:
+        with lock:
+            print(Color.sky('[daemon]') + ' ' + ' '.join(request['argv']), flush=True)
+            pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                for fd in [0, 1, 2]:
+                    os.dup2(connection.fileno(), fd)
+                sys.stdout.reconfigure(line_buffering=True)
+                sys.argv = [sys.argv[0]] + request['argv']
+                main()
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        code = os.waitstatus_to_exitcode(status)
+        try:
+            # discard unread input, which otherwise resets the connection on close.
+            connection.setblocking(False)
+            while connection.recv(65536):
+                pass
+        except OSError:
+            pass
+        try:
+            connection.setblocking(True)
+            connection.sendall('\0runtex-exit:{}\n'.format(code).encode())
+            connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        connection.close()
+    with lock:
+        daemon_warm_up()
+
+
+def daemon():
+    """Serve requests from ``daemon_client`` on ``daemon_socket`` until interrupted.
+
+    Each request is run by a process forked from this process, so that it starts with the
+    configurations and file hashes kept warm in memory. Requests for the same target are
+    serialized, while those for different targets run in parallel."""
+    if os.path.exists(daemon_socket):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(daemon_socket)
+            error('a daemon is already running on {}.'.format(daemon_socket))
+        except OSError:
+            os.remove(daemon_socket)  # stale socket
+        finally:
+            probe.close()
+    os.makedirs(cache_dir, exist_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(daemon_socket)
+    server.listen()
+    lock = threading.Lock()
+    target_locks = dict()
+    daemon_warm_up()
+
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+    print(Color.green('Daemon is listening on ' + Color.b + daemon_socket + Color.g + '. (Ctrl-C to stop)'),
+          flush=True)
+    try:
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(target=daemon_handle, args=(connection, target_locks, lock), daemon=True).start()
+    except KeyboardInterrupt:
+        print("\n" + Color.green('Daemon stopped.'))
+    finally:
+        server.close()
+        remove_file(daemon_socket)
+
+
+def daemon_client(argv, stop=False):
+    """Send the command line ``argv`` to ``daemon``, relay the standard input and output, and
+    return the exit code. If ``stop``, request the daemon to stop instead."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(daemon_socket)
+    except OSError:
+        error('daemon is not running; start it by "{} daemon".'.format(os.path.basename(sys.argv[0])))
+    request = {'stop': True} if stop else {'argv': argv, 'cwd': os.getcwd()}
+    connection.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+    def forward_stdin():
+        try:
+            while True:
+                data = os.read(0, 4096)
+                if not data:
+                    break
+                connection.sendall(data)
+            connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+    threading.Thread(target=forward_stdin, daemon=True).start()
+
+    buffer = b''
+    while True:
+        try:
+            data = connection.recv(65536)
+        except ConnectionResetError:
+            break
+        if not data:
+            break
+        buffer += data
+        position = buffer.find(b'\0')
+        output, buffer = (buffer, b'') if position < 0 else (buffer[:position], buffer[position:])
+        sys.stdout.buffer.write(output)
+        sys.stdout.buffer.flush()
+    connection.close()
+    if buffer.startswith(b'\0runtex-exit:'):
+        return int(buffer[len(b'\0runtex-exit:'):].strip() or 1)
+    sys.stdout.buffer.write(buffer)
+    return 1
+
+
+def main():
+    global use_cache, assume_yes, plan_file
+    if '--daemon' in sys.argv:
+        sys.exit(daemon_client([a for a in sys.argv[1:] if a != '--daemon']))
+    if {'--profile', '--profile-summary'} & set(sys.argv) or [a for a in sys.argv if a.startswith('--profile-output')]:
+        profiler.enabled = True  # enabled before parse_args to profile read_config
+
     config_list = read_config()
 
     if len(config_list) == 0:
         setup()
         sys.exit()
 
+    options = parse_args()
+    use_cache = not options.no_cache
+    assume_yes = options.yes
+    plan_file = options.plan
+    try:
+        execute(options, config_list)
+    finally:
+        if profiler.enabled:
+            profiler.save(options.profile_output)
+            if options.profile_summary:
+                profiler.summary()
+
+
+def execute(options, config_list):
     args_length_dict = dict(
         compile=[0],
         archive=[1],
         JHEP=[1],
         pull=[0, 1],
         push=[0, 1],
+        watch=[0],
+        daemon=[0, 1],
+        versions=[0],
+        checkout=[1],
+        gc=[0],
+        apply=[1],
     )
 
-    args = parse_args()
+    args = list(options.args)
     if len(args) == 0:
         usage('arguments are missing')
 
     command = args.pop(0)
+    if command == 'daemon':
+        if args == ['stop']:
+            sys.exit(daemon_client(None, stop=True))
+        elif args:
+            usage('invalid options are specified for the command "daemon"')
+        daemon()
+        return
+
+    if options.plan and command not in ['push', 'pull']:
+        usage('--plan is available only for the commands "push" and "pull"')
+    if command == 'apply':
+        if len(args) != 1:
+            usage('invalid options are specified for the command "apply"')
+        apply(config_list, args[0])
+        return
+
+    if command == 'affected':
+        for target, reasons in sorted(affected_targets(config_list, args or None).items()):
+            print(target + '\t' + Color.yellow(', '.join(reasons)))
+        return
+    if command == 'compile' and options.affected:
+        if args:
+            usage('invalid options are specified for the command "compile --affected"')
+        targets = sorted(affected_targets(config_list))
+        if not targets:
+            print(Color.green('Nothing to rebuild.'))
+            return
+        sys.exit(0 if run_all(command, targets, args, options.jobs) else 1)
+
     target = args.pop(0) if (len(args) > 0 and args[0] in config_list.keys()) else None
+    if target is None and (options.all or (len(args) > 0 and args[0] == 'all')):
+        if not options.all:
+            args.pop(0)
+        target = 'all'
 
     args_length = args_length_dict.get(command)
     if args_length is None:
         usage('unknown command: ' + command)
+
+    if target == 'all':
+        if command not in ['compile', 'archive', 'JHEP', 'push']:
+            usage('"all" is not available for the command "' + command + '"')
+        if options.plan:
+            usage('--plan is not available with "all"')
+        if len(args) not in args_length:
+            usage('invalid options are specified for the command "' + command + '"')
+        if command == 'push' and not assume_yes:
+            error('"push all" runs unattended; specify --yes to confirm the operations in advance.')
+        item = 'remotedir' if command == 'push' else 'texfile'
+        targets = [name for name, config in config_list.items() if config.get(item)]
+        if not targets:
+            error('no target has "' + item + '" in configuration.')
+        sys.exit(0 if run_all(command, targets, args, options.jobs, warm_start=options.warm) else 1)
     if not(len(args) in args_length):
         usage('invalid options are specified for the command "' + command + '"' +
               ("\n(maybe wrong <texfile> is specified?)" if (len(args) - 1 in args_length and target is None) else ''))
@@ -643,15 +3259,31 @@ if __name__ == '__main__':
     if command == 'compile':
         needs('texfile')
         compile_tex(config_in_use)
+        dependencies = get_recorded_dependencies(config_in_use['texfile'], build_dir_of(config_in_use))
+        if dependencies is not None:
+            update_index(config_in_use['texfile'], dependencies)
     elif command == 'archive':
         needs('texfile')
-        archive(config_in_use, args[0])
+        archive(config_in_use, args[0], warm=options.warm)
     elif command == 'JHEP':
         needs('texfile')
-        archive(config_in_use, args[0], style='JHEP')
+        archive(config_in_use, args[0], style='JHEP', warm=options.warm)
     if command == 'pull':
         needs('remotedir')
         pull(config_in_use, suffix=(args[0] if len(args) == 1 else None))
     elif command == 'push':
         needs('remotedir')
         push(config_in_use, suffix=(args[0] if len(args) == 1 else None))
+    elif command == 'watch':
+        needs('texfile')
+        watch(config_in_use)
+    elif command == 'versions':
+        versions(config_in_use)
+    elif command == 'checkout':
+        checkout(config_in_use, args[0])
+    elif command == 'gc':
+        collect_garbage(config_in_use)
+
+
+if __name__ == '__main__':
+    main()